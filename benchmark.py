@@ -0,0 +1,250 @@
+"""
+Benchmarks for crop_extension on synthetic images.
+
+    python benchmark.py                           # small default matrix
+    python benchmark.py --sizes 1,16,256,1000     # megapixels, up to 1 GP
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json --threshold 0.15
+
+Each case reports the best per-call wall time over --repeat samples (each
+sample loops the call until it lasts at least --min-time), tiles/s, output
+bytes/s and peak memory (tracemalloc peak of a separate run, and the growth
+of the process high-water mark from ru_maxrss). With --compare, cases slower
+than the baseline by more than the threshold are flagged and the exit status
+is 1.
+"""
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+import crop_extension
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+MODES = {"RGB": (np.uint8, 3), "L": (np.uint8, 1), "I;16": (np.uint16, 1), "RGBA": (np.uint8, 4)}
+
+
+def synthetic_image(megapixels, mode, seed=0):
+    """
+    Returns a reproducible PIL image of about megapixels million pixels with a 4:3
+    aspect ratio. Noise is generated for a 1024x1024 block and repeated, so even
+    gigapixel images are quick to make.
+    """
+    width = int(round((megapixels * 1e6 * 4 / 3) ** 0.5))
+    height = int(round(megapixels * 1e6 / width))
+    dtype, channels = MODES[mode]
+    rng = np.random.default_rng(seed)
+    block = rng.integers(0, np.iinfo(dtype).max, (1024, 1024, channels), dtype=dtype,
+                         endpoint=True)
+    array = np.tile(block, (-(-height // 1024), -(-width // 1024), 1))[:height, :width]
+    if channels == 1:
+        array = array[:, :, 0]
+    if mode == "I;16":
+        return Image.frombytes(mode, (width, height), np.ascontiguousarray(array).tobytes())
+    return Image.fromarray(np.ascontiguousarray(array))
+
+
+def _pixel_bytes(mode):
+    dtype, channels = MODES[mode]
+    return np.dtype(dtype).itemsize * channels
+
+
+def _tile_count(result):
+    if isinstance(result, tuple):
+        # sliding_window returns (grid, windows), a lazy strided view; copy it
+        # so the case measures the bytes it reports
+        grid, windows = result
+        np.ascontiguousarray(windows)
+        result = grid
+    return len(result)
+
+
+def benchmark_cases(image, tile, overlaps):
+    """
+    Yields (name, overlap, func) for the functions measured on one image and tile size.
+    func() returns the number of tiles it produced.
+    """
+    width, height = image.size
+    bbox = [width // 3, height // 3, tile // 4, tile // 4]
+
+    def random_crops():
+        random.seed(0)
+        for _ in range(100):
+            crop_extension.random_crop_containing_bbox(image, bbox, (tile, tile))
+        return 100
+
+    yield "random_crop_containing_bbox", 0, random_crops
+    yield "crop_to_grid", 0, lambda: _tile_count(crop_extension.crop_to_grid(image, (tile, tile)))
+    yield "crop_to_grid[array]", 0, lambda: _tile_count(
+        crop_extension.crop_to_grid(image, (tile, tile), out="array"))
+    yield "crop_to_grid_with_offset", 0, lambda: _tile_count(
+        crop_extension.crop_to_grid_with_offset(image, (tile, tile), (tile // 2, tile // 2)))
+    for overlap in overlaps:
+        stride = max(1, int(round(tile * (1 - overlap))))
+        yield "sliding_window", overlap, lambda stride=stride: _tile_count(
+            crop_extension.sliding_window(image, (tile, tile), (stride, stride)))
+
+
+def _max_rss():
+    """
+    Returns the process high-water mark in bytes, or None where unavailable.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def measure(func, repeat=3, memory=True, min_time=0.2):
+    """
+    Takes repeat samples of func and returns the best per-call wall time, its
+    tile count and, with memory set, the tracemalloc peak and ru_maxrss growth
+    of one more run. Fast cases are looped so that each sample lasts at least
+    min_time, which keeps timer noise out of sub-millisecond cases.
+    """
+    start = time.perf_counter()
+    tiles = func()
+    loops = max(1, int(min_time / max(time.perf_counter() - start, 1e-9)) + 1)
+
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = (time.perf_counter() - start) / loops
+        best = elapsed if best is None else min(best, elapsed)
+
+    result = {"seconds": best, "tiles": tiles, "loops": loops,
+              "sample_seconds": best * loops}
+    if memory:
+        gc.collect()
+        rss_before = _max_rss()
+        tracemalloc.start()
+        try:
+            func()
+            result["tracemalloc_peak"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        if rss_before is not None:
+            result["maxrss_growth"] = _max_rss() - rss_before
+    return result
+
+
+def run(sizes, modes, tiles, overlaps, repeat=3, memory=True, min_time=0.2, report=print):
+    """
+    Runs every case and returns {case name: result dict}.
+    """
+    results = {}
+    for megapixels in sizes:
+        for mode in modes:
+            image = synthetic_image(megapixels, mode)
+            for tile in tiles:
+                for name, overlap, func in benchmark_cases(image, tile, overlaps):
+                    key = "{}/{:g}MP/{}/{}/overlap={:g}".format(name, megapixels, mode, tile,
+                                                                 overlap)
+                    result = measure(func, repeat, memory, min_time)
+                    result["tiles_per_second"] = result["tiles"] / result["seconds"]
+                    result["bytes_per_second"] = (result["tiles"] * tile * tile
+                                                  * _pixel_bytes(mode) / result["seconds"])
+                    results[key] = result
+                    report(format_result(key, result))
+            del image
+    return results
+
+
+def format_result(key, result):
+    line = "{:<60} {:>9.4f}s {:>11.1f} tiles/s {:>9.1f} MB/s".format(
+        key, result["seconds"], result["tiles_per_second"], result["bytes_per_second"] / 1e6)
+    if "tracemalloc_peak" in result:
+        line += " peak {:>8.1f} MB".format(result["tracemalloc_peak"] / 1e6)
+    if "maxrss_growth" in result:
+        line += " rss +{:.1f} MB".format(result["maxrss_growth"] / 1e6)
+    return line
+
+
+def compare(results, baseline, threshold=0.1, min_time=0.2):
+    """
+    Returns (key, baseline seconds, seconds) for the cases more than threshold
+    slower than in baseline. Cases missing from either side are ignored, and so
+    are cases whose samples on either side lasted less than min_time, since
+    single short runs are dominated by noise.
+    """
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get("results", {}).get(key)
+        if not previous:
+            continue
+        if min(previous.get("sample_seconds", previous["seconds"]),
+               result.get("sample_seconds", result["seconds"])) < min_time:
+            continue
+        if result["seconds"] > previous["seconds"] * (1 + threshold):
+            regressions.append((key, previous["seconds"], result["seconds"]))
+    return regressions
+
+
+def _csv(parse):
+    return lambda value: [parse(item) for item in value.split(",") if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark crop_extension on synthetic images.")
+    parser.add_argument("--sizes", type=_csv(float), default=[1, 16],
+                        help="image sizes in megapixels (default: 1,16)")
+    parser.add_argument("--modes", type=_csv(str), default=list(MODES),
+                        help="image modes (default: RGB,L,I;16,RGBA)")
+    parser.add_argument("--tiles", type=_csv(int), default=[256, 512],
+                        help="square tile sizes (default: 256,512)")
+    parser.add_argument("--overlaps", type=_csv(float), default=[0, 0.5],
+                        help="sliding window overlaps as a fraction of the tile (default: 0,0.5)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case (default: 3)")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="minimum seconds per timed sample; shorter cases are looped "
+                             "(default: 0.2)")
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory run")
+    parser.add_argument("--save", metavar="JSON", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="JSON", help="flag regressions against a baseline")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="allowed slowdown before a case is flagged (default: 0.1)")
+    args = parser.parse_args(argv)
+
+    for mode in args.modes:
+        if mode not in MODES:
+            parser.error("unsupported mode {!r}".format(mode))
+
+    results = run(args.sizes, args.modes, args.tiles, args.overlaps, args.repeat,
+                  not args.no_memory, args.min_time)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as fp:
+            json.dump({"python": platform.python_version(), "platform": platform.platform(),
+                       "results": results}, fp, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.threshold, args.min_time)
+        for key, before, after in regressions:
+            print("REGRESSION {}: {:.4f}s -> {:.4f}s ({:+.0%})".format(
+                key, before, after, after / before - 1))
+        if regressions:
+            return 1
+        print("no regressions beyond {:.0%}".format(args.threshold))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,488 @@
 import os, sys
-from PIL import Image 
+from PIL import Image, TiffImagePlugin, TiffTags, features
 import random
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import http
+import io
+import re
+import struct
+import threading
+import time
+import urllib.parse
+import warnings
+import zlib
+import numpy as np
 
-def random_crop_containing_bbox(image, bbox, crop_size=(512,512)):
+
+class StageTimings:
     """
-    Randomly crops an image such that the bounding box is fully contained within the crop.
+    Per-stage timing counters for the tiling pipeline (decode, crop, pad, convert,
+    downsample, encode). Each stage keeps a count, the total in nanoseconds and a
+    histogram with power-of-two buckets, from which p50/p99 are estimated.
+    Install one with enable_stage_timing(); with none installed the stages cost
+    a single function call. Thread-safe.
+    """
+
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, ns):
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = [0, 0, [0] * 64]
+            entry[0] += 1
+            entry[1] += ns
+            entry[2][min(ns.bit_length(), 63)] += 1
+
+    @staticmethod
+    def _quantile(buckets, count, q):
+        """
+        Estimates the q quantile in ns, interpolating within its power-of-two bucket.
+        """
+        rank = q * count
+        seen = 0
+        for index, n in enumerate(buckets):
+            if n and seen + n >= rank:
+                lower = 1 << (index - 1) if index else 0
+                return lower + (max(rank - seen, 0) / n) * ((1 << index) - lower)
+            seen += n
+        return 0
+
+    def snapshot(self):
+        """
+        Returns {stage: {"count", "total_ns", "mean_ns", "p50_ns", "p99_ns"}}.
+        """
+        with self._lock:
+            stages = {stage: (count, total, list(buckets))
+                      for stage, (count, total, buckets) in self._stages.items()}
+        return {stage: {"count": count, "total_ns": total, "mean_ns": total / count,
+                        "p50_ns": self._quantile(buckets, count, 0.5),
+                        "p99_ns": self._quantile(buckets, count, 0.99)}
+                for stage, (count, total, buckets) in sorted(stages.items())}
+
+    def prometheus(self, prefix="crop_extension"):
+        """
+        Returns the timings in the Prometheus text format: a <prefix>_stage_seconds
+        histogram and a <prefix>_stage_quantile_seconds gauge for p50 and p99.
+        """
+        with self._lock:
+            stages = {stage: (count, total, list(buckets))
+                      for stage, (count, total, buckets) in self._stages.items()}
+        histogram = prefix + "_stage_seconds"
+        quantiles = prefix + "_stage_quantile_seconds"
+        lines = ["# HELP {} Time spent in each tiling stage.".format(histogram),
+                 "# TYPE {} histogram".format(histogram)]
+        for stage, (count, total, buckets) in sorted(stages.items()):
+            # Every other power of two, from about 1us to about 69s
+            for bit in range(10, 37, 2):
+                lines.append('{}_bucket{{stage="{}",le="{:.9g}"}} {}'.format(
+                    histogram, stage, (1 << bit) / 1e9, sum(buckets[:bit + 1])))
+            lines.append('{}_bucket{{stage="{}",le="+Inf"}} {}'.format(histogram, stage, count))
+            lines.append('{}_sum{{stage="{}"}} {:.9g}'.format(histogram, stage, total / 1e9))
+            lines.append('{}_count{{stage="{}"}} {}'.format(histogram, stage, count))
+        lines += ["# HELP {} Estimated tiling stage time quantiles.".format(quantiles),
+                  "# TYPE {} gauge".format(quantiles)]
+        for stage, (count, total, buckets) in sorted(stages.items()):
+            for q in (0.5, 0.99):
+                lines.append('{}{{stage="{}",quantile="{}"}} {:.9g}'.format(
+                    quantiles, stage, q, self._quantile(buckets, count, q) / 1e9))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="crop_extension"):
+        """
+        Writes prometheus() to path atomically, e.g. for node_exporter's textfile
+        collector (which reads *.prom files).
+        """
+        with open(path + ".tmp", "w", encoding="utf-8") as fp:
+            fp.write(self.prometheus(prefix))
+        os.replace(path + ".tmp", path)
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+
+class _StageSpan:
+    __slots__ = ("timings", "stage", "start")
+
+    def __init__(self, timings, stage):
+        self.timings = timings
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *exc_info):
+        self.timings.record(self.stage, time.perf_counter_ns() - self.start)
+
+
+_stage_timings = None
+_no_stage = contextlib.nullcontext()
+
+
+def enable_stage_timing(timings=None):
+    """
+    Starts recording stage timings into timings (a new StageTimings by default)
+    and returns it.
+    """
+    global _stage_timings
+    _stage_timings = timings or StageTimings()
+    return _stage_timings
+
+
+def disable_stage_timing():
+    """
+    Stops recording stage timings and returns the StageTimings that was in use.
+    """
+    global _stage_timings
+    timings, _stage_timings = _stage_timings, None
+    return timings
+
+
+def _stage(name):
+    """
+    Context manager timing a pipeline stage; a shared no-op while timing is disabled.
+    """
+    timings = _stage_timings
+    if timings is None:
+        return _no_stage
+    return _StageSpan(timings, name)
+
+
+def _decode(image):
+    """
+    Loads a lazily opened PIL image, timed as the decode stage.
+    """
+    if isinstance(image, Image.Image):
+        with _stage("decode"):
+            image.load()
+    return image
+
+
+def _open_lazy_source(path):
+    """
+    Returns a memory map for .npy paths, a TiledTiffReader for tiled TIFFs, or
+    None for files that have to be decoded as a whole.
+    """
+    path = os.fspath(path)
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    if path.lower().endswith((".tif", ".tiff")):
+        return TiledTiffReader.open(path)
+    return None
+
+
+def _open_source(image):
+    """
+    Returns a tileable source: PIL images and ndarrays (including np.memmap) are
+    used as is, .npy paths are memory-mapped, tiled TIFFs get a TiledTiffReader
+    and other paths are opened with PIL.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        source = _open_lazy_source(image)
+        return source if source is not None else Image.open(image)
+    return image
+
+
+def _close_opened(source, image):
+    """
+    Closes source if it was opened here from the path image; sources that were
+    passed in as objects belong to the caller and stay open.
+    """
+    if isinstance(image, (str, os.PathLike)) and hasattr(source, "close"):
+        source.close()
+
+
+def _close_uncached(source, image, cache):
+    """
+    _close_opened for sources from _open_cached: decoded images held by cache are
+    shared and stay open, while readers and memory maps are never cached.
+    """
+    if not cache or not isinstance(source, Image.Image):
+        _close_opened(source, image)
+
+
+def _closing(items, source, image):
+    """
+    Yields from items, then closes source like _close_opened.
+    """
+    try:
+        yield from items
+    finally:
+        _close_opened(source, image)
+
+
+def _image_size(image):
+    """
+    Returns the (width, height) of a PIL image or an (H, W[, C]) array.
+    """
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+
+def _source_size(path):
+    """
+    Returns the (width, height) of the image at path, closing it again.
+    """
+    source = _open_source(path)
+    if isinstance(source, np.ndarray):
+        return _image_size(source)
+    with source:
+        return _image_size(source)
+
+
+def _crop(image, box):
+    """
+    Crops box out of a PIL image or an array as a PIL image.
+    For arrays and memory maps only the rows and columns of the box are read.
     """
+    with _stage("crop"):
+        if not isinstance(image, np.ndarray):
+            return image.crop(box)
+        left, upper, right, lower = box
+        region = np.array(image[upper:lower, left:right])
+        if region.ndim == 3 and region.shape[2] == 1:
+            region = region[:, :, 0]
+        return Image.fromarray(region)
+
+
+def _to_array(image):
+    """
+    Returns the pixels of a PIL image or array-like as an ndarray of shape (H, W, C).
+    """
+    source = _open_source(image)
+    try:
+        pixels = source
+        if isinstance(source, TiledTiffReader):
+            pixels = source.crop((0, 0) + source.size)
+        _decode(pixels)
+        with _stage("convert"):
+            array = np.asarray(pixels)
+    finally:
+        _close_opened(source, image)
+    if array.ndim == 2:
+        array = array[:, :, np.newaxis]
+    return array
+
+
+def _scale_factor(scale):
+    """
+    Returns the integer reduction factor for a scale of 1, 1/2, 1/3, ...
+    """
+    factor = int(round(1 / scale)) if scale > 0 else 0
+    if factor < 1 or abs(factor * scale - 1) > 1e-6:
+        raise ValueError("scale must be 1/n for a positive integer n, got {}".format(scale))
+    return factor
+
+
+def _open_scaled(image, scale=1, draft=True):
+    """
+    Opens an image reduced to scale, e.g. 0.25 for a quarter of the resolution.
+    JPEGs that have not been loaded yet are decoded straight to 1/2, 1/4 or 1/8
+    scale with PIL's draft mode, and Image.reduce handles whatever factor is left.
+    The result is (width + n - 1) // n by (height + n - 1) // n for scale 1/n.
+    Draft mode is only used on images opened here from a path (and not with
+    draft=False), since it permanently shrinks the image it is applied to.
+    """
+    factor = _scale_factor(scale)
+    draft = draft and isinstance(image, (str, os.PathLike))
+    source = _open_source(image)
+    if factor == 1:
+        return source
+    if not isinstance(source, Image.Image):
+        try:
+            return _reduce_banded(source, factor)
+        finally:
+            _close_opened(source, image)
+    image = source
+
     width, height = image.size
+    if draft:
+        draft = max(d for d in (1, 2, 4, 8) if factor % d == 0)
+        if draft > 1:
+            image.draft(image.mode, ((width + draft - 1) // draft, (height + draft - 1) // draft))
+
+    # draft is a no-op for loaded images and other formats, so check what it did
+    applied = 1
+    for d in (8, 4, 2):
+        if image.size == ((width + d - 1) // d, (height + d - 1) // d):
+            applied = d
+            break
+    if factor // applied > 1:
+        with _stage("decode"):
+            image = _reduce(image, factor // applied)
+    return image
+
+
+def _reduce(image, factor):
+    """
+    Image.reduce, also for I;16 images, which it has no path for.
+    """
+    if image.mode.startswith("I;16"):
+        return image.convert("I").reduce(factor).convert(image.mode)
+    return image.reduce(factor)
+
+
+def _reduce_banded(image, factor, band_bytes=32 << 20):
+    """
+    Reduces an array, memory map or TiledTiffReader by factor like Image.reduce,
+    reading about band_bytes of source rows at a time rather than the full frame.
+    """
+    width, height = _image_size(image)
+    rows = factor * max(1, band_bytes // (4 * width * factor))
+    reduced = None
+    for upper in range(0, height, rows):
+        with _stage("decode"):
+            band = _reduce(_crop(image, (0, upper, width, min(upper + rows, height))), factor)
+        if reduced is None:
+            reduced = Image.new(band.mode, (-(-width // factor), -(-height // factor)))
+        reduced.paste(band, (0, upper // factor))
+    return reduced
+
+
+def _image_nbytes(image):
+    """
+    Returns the approximate memory held by a decoded PIL image or an array.
+    """
+    if isinstance(image, np.ndarray):
+        return image.nbytes
+    if image.mode in ("I", "F"):
+        pixel_bytes = 4
+    elif image.mode.startswith("I;16"):
+        pixel_bytes = 2
+    else:
+        # PIL keeps 2-4 band 8-bit images in 4 bytes per pixel
+        pixel_bytes = 4 if len(image.getbands()) > 1 else 1
+    return image.width * image.height * pixel_bytes
+
+
+def _file_key(path):
+    """
+    Identifies the current contents of a file as (absolute path, mtime, size).
+    """
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+class DecodedImageCache:
+    """
+    Process-wide LRU cache of decoded images, bounded by their total size in bytes.
+    Entries are keyed by (path, mtime, file size, decode scale), so a file that
+    changes on disk is decoded again. Cached images are shared between callers
+    and must not be modified in place. Thread-safe.
+    """
+
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, scale=1):
+        """
+        Returns the image at path decoded at scale, decoding it on a miss.
+        """
+        key = _file_key(path) + (_scale_factor(scale),)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # Decode outside the lock so other images can be served meanwhile
+        image = _open_scaled(path, scale)
+        if not isinstance(image, Image.Image):
+            # Memory maps and tiled readers are read lazily; nothing to cache
+            return image
+        _decode(image)
+        nbytes = _image_nbytes(image)
+        if nbytes > self.max_bytes:
+            return image
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (image, nbytes)
+                self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+                self.evictions += 1
+            return self._entries[key][0] if key in self._entries else image
+
+    def stats(self):
+        """
+        Returns the hit/miss/eviction counters and the current size as a dict.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self.current_bytes,
+                    "max_bytes": self.max_bytes}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+decoded_images = DecodedImageCache()
+
+
+def _open_cached(image, scale=1, cache=None):
+    """
+    Like _open_scaled, but decodes image paths through cache: a DecodedImageCache,
+    True for the process-wide decoded_images, or None for no caching.
+    """
+    if cache is True:
+        cache = decoded_images
+    if cache and isinstance(image, (str, os.PathLike)) \
+            and not os.fspath(image).endswith(".npy"):
+        return cache.get(image, scale)
+    return _open_scaled(image, scale)
+
+
+def random_crop_containing_bbox(image, bbox, crop_size=(512,512), scale=1, cache=None):
+    """
+    Randomly crops an image such that the bounding box is fully contained within the crop.
+    With scale=1/n the image is decoded at reduced resolution (see _open_scaled),
+    bbox is given in full-resolution pixels and crop_size in reduced pixels.
+    With cache=True (or a DecodedImageCache) image paths are decoded once and reused.
+    """
+    factor = _scale_factor(scale)
+    source = _open_cached(image, scale, cache)
+    try:
+        return _random_crop(source, bbox, crop_size, factor)
+    finally:
+        _close_uncached(source, image, cache)
+
+
+def _random_crop(image, bbox, crop_size, factor):
+    """
+    random_crop_containing_bbox on an opened source reduced by factor.
+    """
+    width, height = _image_size(image)
     # Convert bbox from [x,y,w,h] to [x1,y1,x2,y2]
     x, y, w, h = bbox
     bbox_x1, bbox_y1, bbox_x2, bbox_y2 = x, y, x + w, y + h
 
+    # Rescale the bounding box outwards to the reduced resolution
+    if factor > 1:
+        bbox_x1, bbox_y1 = bbox_x1 // factor, bbox_y1 // factor
+        bbox_x2, bbox_y2 = -(-bbox_x2 // factor), -(-bbox_y2 // factor)
+
     # Ensure the bounding box is within the image dimensions
     if (bbox_x1 < 0 or bbox_y1 < 0 or bbox_x2 > width or bbox_y2 > height):
         raise ValueError("Bounding box is out of image bounds")
@@ -38,46 +510,771 @@ def random_crop_containing_bbox(image, bbox, crop_size=(512,512)):
         y = height - crop_size[1]
 
     # Crop the image
-    cropped_image = image.crop((x, y, x + crop_size[0], y + crop_size[1]))
+    cropped_image = _crop(_decode(image), (x, y, x + crop_size[0], y + crop_size[1]))
 
     return cropped_image
 
 
-def crop_to_grid(image, tile_size=(512, 512)):
+class TileGrid:
+    """
+    Tile coordinates for an image size, computed up front without touching pixels.
+    boxes is an (N, 4) int32 array of (left, upper, right, lower) source regions,
+    clipped to the image, and positions the matching (N, 2) array of (row, col).
+    Tiles are ordered by order: "column" (column by column, the crop_to_grid
+    default), "row" (row by row, matching row-major pixel, strip and memmap
+    storage), or the locality-preserving "morton" (Z-order) and "hilbert" curves.
+    Windows start at origin and step by stride (tile_size by default; smaller
+    strides overlap). edge="pad" adds windows until the image is covered, with
+    partial edge tiles to be zero-padded; edge="shift" covers the image with the
+    same windows but moves the last row and column back flush with the border,
+    overlapping their neighbours instead of padding; edge="drop" keeps only full
+    windows.
+    """
+    __slots__ = ("image_size", "tile_size", "stride", "origin", "order", "rows", "cols", "boxes",
+                 "positions", "_index")
+
+    def __init__(self, image_size, tile_size=(512, 512), stride=None, origin=(0, 0), edge="pad",
+                 order="column"):
+        width, height = image_size
+        tile_width, tile_height = tile_size
+        stride_x, stride_y = stride or tile_size
+        origin_x, origin_y = origin
+        if stride_x <= 0 or stride_y <= 0 or origin_x < 0 or origin_y < 0:
+            raise ValueError("stride must be positive and origin non-negative")
+
+        # Calculate the number of crops needed in each dimension
+        def count(extent, tile, step):
+            if edge in ("pad", "shift"):
+                return 0 if extent <= 0 else max(-(-(extent - tile) // step), 0) + 1
+            if edge == "drop":
+                return 0 if extent < tile else (extent - tile) // step + 1
+            raise ValueError("edge must be 'pad', 'shift' or 'drop'")
+
+        num_crops_x = count(width - origin_x, tile_width, stride_x)
+        num_crops_y = count(height - origin_y, tile_height, stride_y)
+
+        # (row, col) positions in traversal order
+        cols, rows = np.meshgrid(np.arange(num_crops_x), np.arange(num_crops_y), indexing="ij")
+        positions = np.stack([rows.ravel(), cols.ravel()], axis=1).astype(np.int32)
+        positions = positions[_traversal_order(positions, order)]
+
+        boxes = np.empty((len(positions), 4), dtype=np.int32)
+        boxes[:, 0] = origin_x + positions[:, 1] * stride_x
+        boxes[:, 1] = origin_y + positions[:, 0] * stride_y
+        if edge == "shift":
+            # Pull the last windows back inside the image; only pad if the tile is larger
+            np.minimum(boxes[:, 0], max(width - tile_width, origin_x), out=boxes[:, 0])
+            np.minimum(boxes[:, 1], max(height - tile_height, origin_y), out=boxes[:, 1])
+        boxes[:, 2] = np.minimum(boxes[:, 0] + tile_width, width)
+        boxes[:, 3] = np.minimum(boxes[:, 1] + tile_height, height)
+
+        index = np.full((num_crops_y, num_crops_x), -1, dtype=np.int32)
+        index[positions[:, 0], positions[:, 1]] = np.arange(len(positions), dtype=np.int32)
+
+        # Grids are shared through for_size, so keep the arrays read-only
+        for array in (positions, boxes, index):
+            array.flags.writeable = False
+
+        self.image_size = (width, height)
+        self.tile_size = (tile_width, tile_height)
+        self.stride = (stride_x, stride_y)
+        self.origin = (origin_x, origin_y)
+        self.order = order
+        self.rows = num_crops_y
+        self.cols = num_crops_x
+        self.boxes = boxes
+        self.positions = positions
+        self._index = index
+
+    @classmethod
+    def for_size(cls, image_size, tile_size=(512, 512), stride=None, origin=(0, 0), edge="pad",
+                 order="column"):
+        """
+        Returns a cached grid shared by every image of the same size.
+        """
+        return _cached_grid(cls, tuple(image_size), tuple(tile_size),
+                            tuple(stride or tile_size), tuple(origin), edge, order)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __getitem__(self, key):
+        """
+        Returns the box of tile number key, or of the tile at key=(row, col).
+        """
+        if isinstance(key, tuple):
+            key = self.index(*key)
+        return tuple(int(v) for v in self.boxes[key])
+
+    def __iter__(self):
+        for (row, col), box in zip(self.positions.tolist(), self.boxes.tolist()):
+            yield row, col, tuple(box)
+
+    def index(self, row, col):
+        """
+        Returns the tile number of the tile at (row, col).
+        """
+        if not (0 <= row < self.rows and 0 <= col < self.cols) or self._index[row, col] < 0:
+            raise IndexError("no tile at row {}, col {}".format(row, col))
+        return int(self._index[row, col])
+
+    def subset(self, keep):
+        """
+        Returns a grid with only the tiles selected by keep, a boolean mask or an
+        array of tile numbers, in their original order. Rows and cols are unchanged.
+        """
+        keep = np.asarray(keep)
+        if keep.dtype == bool:
+            keep = np.flatnonzero(keep)
+        keep = np.sort(keep)
+
+        grid = object.__new__(type(self))
+        for name in ("image_size", "tile_size", "stride", "origin", "order", "rows", "cols"):
+            setattr(grid, name, getattr(self, name))
+        grid.boxes = self.boxes[keep]
+        grid.positions = self.positions[keep]
+        index = np.full((self.rows, self.cols), -1, dtype=np.int32)
+        index[grid.positions[:, 0], grid.positions[:, 1]] = np.arange(len(keep), dtype=np.int32)
+        grid._index = index
+        for array in (grid.boxes, grid.positions, grid._index):
+            array.flags.writeable = False
+        return grid
+
+    def __repr__(self):
+        return ("TileGrid(image_size={}, tile_size={}, stride={}, origin={}, order={!r}, "
+                "rows={}, cols={})").format(self.image_size, self.tile_size, self.stride,
+                                            self.origin, self.order, self.rows, self.cols)
+
+
+@functools.lru_cache(maxsize=256)
+def _cached_grid(cls, image_size, tile_size, stride, origin, edge, order):
+    return cls(image_size, tile_size, stride=stride, origin=origin, edge=edge, order=order)
+
+
+def _traversal_order(positions, order):
+    """
+    Returns the permutation that sorts (row, col) positions into a traversal order.
+    """
+    rows = positions[:, 0].astype(np.int64)
+    cols = positions[:, 1].astype(np.int64)
+    if order == "column":
+        return np.lexsort((rows, cols))
+    if order == "row":
+        return np.lexsort((cols, rows))
+
+    # Curves are defined on a power-of-two square covering the grid
+    side = 1
+    while side < max(int(rows.max(initial=0)), int(cols.max(initial=0))) + 1:
+        side *= 2
+
+    if order == "morton":
+        key = np.zeros_like(rows)
+        for bit in range(side.bit_length()):
+            key |= ((cols >> bit) & 1) << (2 * bit)
+            key |= ((rows >> bit) & 1) << (2 * bit + 1)
+        return np.argsort(key, kind="stable")
+    if order == "hilbert":
+        x, y = cols.copy(), rows.copy()
+        key = np.zeros_like(rows)
+        step = side // 2
+        while step > 0:
+            rx = (x & step) > 0
+            ry = (y & step) > 0
+            key += step * step * ((3 * rx) ^ ry)
+            # Rotate the quadrant so the curve stays continuous
+            flip = ~ry & rx
+            x = np.where(flip, side - 1 - x, x)
+            y = np.where(flip, side - 1 - y, y)
+            x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+            step //= 2
+        return np.argsort(key, kind="stable")
+    raise ValueError("order must be 'column', 'row', 'morton' or 'hilbert'")
+
+
+def iter_tiles(image, grid, pad="constant", fill=0):
+    """
+    Lazily crops the tiles of a TileGrid out of an image, one tile at a time.
+    Yields (row, col, box, tile); tiles smaller than the grid size are padded
+    according to pad and fill (see _crop_padded), keeping the source mode.
+    """
+    source = _decode(_open_source(image))
+    try:
+        for row, col, box in grid:
+            yield row, col, box, _crop_padded(source, box, grid.tile_size, pad, fill)
+    finally:
+        _close_opened(source, image)
+
+
+def _region(image, box):
+    """
+    Returns the pixels of box in a PIL image or an array as an ndarray.
+    """
+    left, upper, right, lower = box
+    if isinstance(image, np.ndarray):
+        return np.asarray(image[upper:lower, left:right])
+    return np.asarray(image.crop(box))
+
+
+def _array_to_image(array, mode=None, palette=None):
+    """
+    Converts an (H, W[, C]) array back to a PIL image, in mode if given.
+    """
+    if array.ndim == 3 and array.shape[2] == 1:
+        array = array[:, :, 0]
+    if mode is None or mode == "1":
+        return Image.fromarray(array)
+    image = Image.frombytes(mode, (array.shape[1], array.shape[0]),
+                            np.ascontiguousarray(array).tobytes())
+    if palette is not None:
+        image.putpalette(palette[1], palette[0])
+    return image
+
+
+def _pad_widths(region, pad_y, pad_x):
+    return ((0, pad_y), (0, pad_x)) + ((0, 0),) * (region.ndim - 2)
+
+
+def _padded_region(image, box, tile_size, pad="constant", fill=0):
+    """
+    Returns the pixels of box as a tile_size array, padded past the image edge
+    with fill (pad="constant"), by mirroring (pad="reflect") or by repeating the
+    border pixels (pad="edge"). Mirroring reads the pixels before the box that
+    it needs, so the result matches padding the whole source with np.pad.
+    """
+    left, upper, right, lower = box
+    tile_width, tile_height = tile_size
+    pad_x = tile_width - (right - left)
+    pad_y = tile_height - (lower - upper)
+
+    if pad == "constant":
+        region = _region(image, box)
+        tile = np.empty((tile_height, tile_width) + region.shape[2:], dtype=region.dtype)
+        tile[...] = fill
+        tile[:lower - upper, :right - left] = region
+        return tile
+    if pad in ("reflect", "edge"):
+        context_left, context_upper = max(left - pad_x, 0), max(upper - pad_y, 0)
+        region = _region(image, (context_left, context_upper, right, lower))
+        tile = np.pad(region, _pad_widths(region, pad_y, pad_x), mode=pad)
+        return tile[upper - context_upper:, left - context_left:]
+    raise ValueError("pad must be 'constant', 'reflect' or 'edge'")
+
+
+def _crop_padded(image, box, tile_size, pad="constant", fill=0):
+    """
+    Crops box out of a PIL image or an array as a PIL tile of tile_size.
+    Tiles that run past the image edge are padded (see _padded_region) without
+    changing the mode, so L, I;16, F and RGBA sources give L, I;16, F and RGBA tiles.
+    """
+    left, upper, right, lower = box
+    if (right - left, lower - upper) == tuple(tile_size):
+        return _crop(image, box)
+
+    with _stage("pad"):
+        tile = _padded_region(image, box, tile_size, pad, fill)
+    with _stage("convert"):
+        if isinstance(image, np.ndarray):
+            return _array_to_image(tile)
+        palette = image.palette.getdata() if image.mode == "P" and image.palette else None
+        return _array_to_image(tile, image.mode, palette)
+
+
+def _pad_source(array, pad_y, pad_x, pad="constant", fill=0):
+    """
+    Pads an (H, W, C) array at the bottom and right in one vectorized step.
+    """
+    if not pad_x and not pad_y:
+        return array
+    if pad == "constant":
+        height, width = array.shape[:2]
+        padded = np.empty((height + pad_y, width + pad_x) + array.shape[2:], dtype=array.dtype)
+        padded[...] = fill
+        padded[:height, :width] = array
+        return padded
+    if pad in ("reflect", "edge"):
+        return np.pad(array, _pad_widths(array, pad_y, pad_x), mode=pad)
+    raise ValueError("pad must be 'constant', 'reflect' or 'edge'")
+
+
+def extract_tiles(image, grid, out=None, workers=None, pad="constant", fill=0):
+    """
+    Copies the tiles of a TileGrid into one (N, tile_height, tile_width, C) ndarray.
+    Tiles are written straight from the source pixels; edge tiles are padded in
+    place according to pad and fill (see _padded_region).
+    Pass a preallocated out buffer to reuse it across images, and workers to
+    copy tiles on a thread pool.
+    """
+    array = _to_array(image)
+    tile_width, tile_height = grid.tile_size
+    shape = (len(grid), tile_height, tile_width, array.shape[2])
+
+    if out is None:
+        out = np.empty(shape, dtype=array.dtype)
+    elif out.shape != shape:
+        raise ValueError("out has shape {}, expected {}".format(out.shape, shape))
+
+    def copy_tile(entry):
+        index, (left, upper, right, lower) = entry
+        if pad != "constant" and (right - left, lower - upper) != (tile_width, tile_height):
+            with _stage("pad"):
+                out[index] = _padded_region(array, (left, upper, right, lower), grid.tile_size,
+                                            pad)
+            return
+        with _stage("crop"):
+            out[index, :lower - upper, :right - left] = array[upper:lower, left:right]
+        if lower - upper < tile_height or right - left < tile_width:
+            with _stage("pad"):
+                out[index, lower - upper:] = fill
+                out[index, :lower - upper, right - left:] = fill
+
+    if pad not in ("constant", "reflect", "edge"):
+        raise ValueError("pad must be 'constant', 'reflect' or 'edge'")
+    entries = enumerate(grid.boxes.tolist())
+    if workers and workers > 1:
+        for _ in ParallelTiler(workers).map(copy_tile, entries):
+            pass
+    else:
+        for entry in entries:
+            copy_tile(entry)
+
+    return out
+
+
+def tile_stats(image, grid, band_bytes=16 << 20):
+    """
+    Returns the (mean, std) of the grayscale pixels inside each tile box of grid,
+    as two (N,) float64 arrays. Both come from summed-area tables of the pixels
+    and their squares, so each tile costs O(1). The tables are only kept at the
+    rows and columns where boxes start or end, and are accumulated from bands of
+    about band_bytes of source rows, so the image is never copied as a whole.
+    Gray is the mean of the first three channels (or the only channel).
+    """
+    source = _open_source(image)
+    width, height = _image_size(source)
+    left, upper, right, lower = grid.boxes.T.astype(np.intp)
+    xs = np.unique(np.concatenate([[0], left, right]))
+    ys = np.unique(np.concatenate([[0], upper, lower]))
+    band_rows = max(1, band_bytes // max(4 * width, 1))
+
+    sums = squares = None
+    row_sums = row_squares = None
+    channels = 1
+    done = 0
+    try:
+        for index, y in enumerate(ys.tolist()):
+            for top in range(done, y, band_rows):
+                region = _region(source, (0, top, width, min(top + band_rows, y)))
+                if sums is None:
+                    # Integer pixels sum exactly in uint64; differences of wrapped
+                    # table entries are still exact for any box below 2**64
+                    dtype = np.uint64 if region.dtype.kind in "uib" else np.float64
+                    sums = np.zeros((len(ys), len(xs)), dtype)
+                    squares = np.zeros_like(sums)
+                    row_sums = np.zeros(width, dtype)
+                    row_squares = np.zeros(width, dtype)
+                if region.ndim == 3 and region.shape[2] >= 3:
+                    gray = region[:, :, :3].sum(axis=2, dtype=sums.dtype)
+                    channels = 3
+                else:
+                    gray = region.reshape(region.shape[:2]).astype(sums.dtype)
+                row_sums += gray.sum(axis=0)
+                row_squares += (gray * gray).sum(axis=0)
+            done = y
+            if sums is not None:
+                sums[index, 1:] = np.cumsum(row_sums)[xs[1:] - 1]
+                squares[index, 1:] = np.cumsum(row_squares)[xs[1:] - 1]
+    finally:
+        _close_opened(source, image)
+    if sums is None:
+        sums = squares = np.zeros((len(ys), len(xs)))
+
+    columns = np.searchsorted(xs, left), np.searchsorted(xs, right)
+    rows = np.searchsorted(ys, upper), np.searchsorted(ys, lower)
+    area = np.maximum((right - left) * (lower - upper), 1)
+
+    def box_sum(table):
+        total = (table[rows[1], columns[1]] - table[rows[0], columns[1]]
+                 - table[rows[1], columns[0]] + table[rows[0], columns[0]])
+        return total.astype(np.float64)
+
+    mean = box_sum(sums) / (channels * area)
+    variance = np.maximum(box_sum(squares) / (channels * channels * area) - mean * mean, 0)
+    return mean, np.sqrt(variance)
+
+
+class BlankTileFilter:
+    """
+    skip_if filter rejecting flat tiles: those with a grayscale std below max_std,
+    and optionally those whose mean is below min_mean or above max_mean (e.g.
+    white slide background). Counts checked and rejected tiles across calls.
+    """
+
+    def __init__(self, max_std=8.0, min_mean=None, max_mean=None):
+        self.max_std = max_std
+        self.min_mean = min_mean
+        self.max_mean = max_mean
+        self.checked = 0
+        self.rejected = 0
+
+    def __call__(self, mean, std):
+        skip = std < self.max_std
+        if self.min_mean is not None:
+            skip |= mean < self.min_mean
+        if self.max_mean is not None:
+            skip |= mean > self.max_mean
+        self.checked += len(skip)
+        self.rejected += int(skip.sum())
+        return skip
+
+
+def filter_tiles(image, grid, skip_if):
+    """
+    Drops tiles before any of them is cropped. skip_if is called once with the
+    (mean, std) arrays from tile_stats and returns a boolean array, True for
+    tiles to skip. Returns (kept_grid, rejected_count).
+    """
+    skip = np.asarray(skip_if(*tile_stats(image, grid)), dtype=bool)
+    return grid.subset(~skip), int(skip.sum())
+
+
+def _otsu_threshold(values):
+    """
+    Returns the Otsu threshold of an array of uint8 values.
+    """
+    histogram = np.bincount(values.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight_low = np.cumsum(histogram)
+    weight_high = weight_low[-1] - weight_low
+    sum_low = np.cumsum(histogram * levels)
+    mean_low = sum_low / np.maximum(weight_low, 1)
+    mean_high = (sum_low[-1] - sum_low) / np.maximum(weight_high, 1)
+    between = weight_low * weight_high * (mean_low - mean_high) ** 2
+    return int(np.argmax(between))
+
+
+def _stretch_to_8bit(thumbnail):
+    """
+    Maps a 16-bit, 32-bit or float thumbnail linearly from its min..max onto an
+    "L" image; other modes are returned as is.
+    """
+    if thumbnail.mode not in ("I", "F") and not thumbnail.mode.startswith("I;16"):
+        return thumbnail
+    values = np.asarray(thumbnail, dtype=np.float64)
+    low, high = np.nanmin(values), np.nanmax(values)
+    if not high > low:
+        return Image.new("L", thumbnail.size)
+    scaled = np.nan_to_num((values - low) * (255 / (high - low)))
+    return Image.fromarray(scaled.round().astype(np.uint8))
+
+
+def foreground_mask(image, scale=1 / 32, method="otsu"):
+    """
+    Computes a boolean foreground (e.g. tissue) mask from a thumbnail of the image
+    decoded at scale, using reduced-resolution decoding where possible.
+    method="otsu" keeps pixels darker than the Otsu threshold of the gray levels;
+    method="saturation" keeps pixels more saturated than the Otsu threshold of
+    the HSV saturation, which ignores gray pen marks and shadows.
+    16-bit, 32-bit and float images are stretched to 8 bits first, since
+    converting them to "L" would clip everything above 255.
+    """
+    if method not in ("otsu", "saturation"):
+        raise ValueError("method must be 'otsu' or 'saturation'")
+    source = _open_scaled(image, scale)
+    try:
+        thumbnail = source
+        if not isinstance(thumbnail, Image.Image):
+            thumbnail = _crop(thumbnail, (0, 0) + _image_size(thumbnail))
+        thumbnail = _stretch_to_8bit(thumbnail)
+
+        if method == "otsu":
+            values = np.asarray(thumbnail.convert("L"))
+            return values <= _otsu_threshold(values)
+        values = np.asarray(thumbnail.convert("RGB").convert("HSV"))[:, :, 1]
+        return values > _otsu_threshold(values)
+    finally:
+        _close_opened(source, image)
+
+
+def foreground_fraction(mask, grid):
+    """
+    Returns the fraction of foreground mask pixels under each tile of grid, as an
+    (N,) float64 array. The mask may be at any resolution covering the same image.
+    """
+    mask_height, mask_width = mask.shape
+    width, height = grid.image_size
+    sums = np.zeros((mask_height + 1, mask_width + 1))
+    np.cumsum(np.cumsum(mask, axis=0), axis=1, out=sums[1:, 1:])
+
+    # Map each box outwards onto the mask grid, at least one mask pixel wide
+    left, upper, right, lower = grid.boxes.T.astype(np.int64)
+    left = np.minimum(left * mask_width // width, mask_width - 1)
+    upper = np.minimum(upper * mask_height // height, mask_height - 1)
+    right = np.maximum(-(-right * mask_width // width), left + 1)
+    lower = np.maximum(-(-lower * mask_height // height), upper + 1)
+
+    inside = sums[lower, right] - sums[upper, right] - sums[lower, left] + sums[upper, left]
+    return inside / ((right - left) * (lower - upper))
+
+
+def _plan_tiles(source, image, tile_size, skip_if=None, foreground=None,
+                mask_scale=1 / 32, mask_method="otsu", edge="pad", order="column"):
+    """
+    Returns the TileGrid of image, minus tiles rejected by the foreground mask
+    (computed from source) or by skip_if.
+    """
+    grid = TileGrid.for_size(_image_size(image), tile_size, edge=edge, order=order)
+    if foreground is not None:
+        mask = foreground_mask(source, mask_scale, mask_method)
+        grid = grid.subset(foreground_fraction(mask, grid) >= foreground)
+    if skip_if is not None:
+        grid, _ = filter_tiles(image, grid, skip_if)
+    return grid
+
+
+def iter_grid_tiles(image, tile_size=(512, 512), scale=1, skip_if=None, foreground=None,
+                    mask_scale=1 / 32, mask_method="otsu", pad="constant", fill=0, edge="pad",
+                    order="column", cache=None):
+    """
+    Lazily crops an image into a grid of specified size, one tile at a time.
+    Yields (row, col, box, tile) where box is the (left, upper, right, lower)
+    region of the source image covered by the tile.
+    Pad the tile if necessary to make it the full grid size: with fill for
+    pad="constant" (zeros by default), or pad="reflect" / "edge". The source
+    mode is kept. edge="shift" moves the last row and column of tiles flush
+    with the border instead of padding them, and edge="drop" leaves them out;
+    box always gives each tile's true position. order picks the traversal:
+    "column" (default), "row", "morton" or "hilbert" (see TileGrid).
+    With scale=1/n the image is decoded at reduced resolution first; tile_size
+    and boxes are then in reduced pixels (multiply boxes by n for full resolution).
+    Tiles for which skip_if is true are never cropped (see filter_tiles).
+    With foreground set, only tiles whose foreground fraction (see
+    foreground_mask, computed at mask_scale) is at least foreground are cropped.
+    With cache=True (or a DecodedImageCache) image paths are decoded once and reused.
+    """
+    source = _open_cached(image, scale, cache)
+    try:
+        grid = _plan_tiles(image, source, tile_size, skip_if, foreground, mask_scale,
+                           mask_method, edge, order)
+    except BaseException:
+        _close_uncached(source, image, cache)
+        raise
+    tiles = iter_tiles(source, grid, pad, fill)
+    if cache and isinstance(source, Image.Image):
+        return tiles
+    return _closing(tiles, source, image)
+
+
+def crop_to_grid(image, tile_size=(512, 512), out=None, scale=1, workers=None, skip_if=None,
+                 foreground=None, mask_scale=1 / 32, mask_method="otsu", pad="constant", fill=0,
+                 edge="pad", order="column", cache=None):
     """
     Crops an image into a grid of specified size. 
-    Zero-pad the image if necessary to make it divisible by the grid size.
+    Pad the image if necessary to make it divisible by the grid size: with fill
+    for pad="constant" (zeros by default), or pad="reflect" / "edge". Tiles keep
+    the source mode. edge="shift" instead moves the last row and column of tiles
+    flush with the border, and edge="drop" leaves them out; the tile offsets are
+    the boxes of TileGrid.for_size(size, tile_size, edge=edge, order=order).
+    order picks the tile order: "column" (default), "row", "morton" or "hilbert".
+    Returns a list of PIL tiles by default. With out="array", or a preallocated
+    (N, tile_height, tile_width, C) ndarray as out, the tiles are written into
+    a single contiguous buffer in the same order and that buffer is returned.
+    With scale=1/n the grid is cut from the image decoded at reduced resolution.
+    With workers > 1 the tiles are cropped on a thread pool, in the same order.
+    Tiles for which skip_if is true are left out before cropping; pass a
+    BlankTileFilter to get the rejected count afterwards.
+    With foreground set, only tiles whose foreground fraction (see
+    foreground_mask, computed at mask_scale) is at least foreground are kept.
+    With cache=True (or a DecodedImageCache) image paths are decoded once and reused.
     """
-    width, height = image.size
+    source = _open_cached(image, scale, cache)
+    try:
+        pixels = source if out is None else _to_array(source)
+        grid = _plan_tiles(image, pixels, tile_size, skip_if, foreground, mask_scale,
+                           mask_method, edge, order)
+
+        if out is None:
+            if workers and workers > 1:
+                tiles = ParallelTiler(workers).iter_tiles(pixels, grid, pad, fill)
+                return [crop for _, _, _, crop in tiles]
+            return [crop for _, _, _, crop in iter_tiles(pixels, grid, pad, fill)]
+
+        if isinstance(out, str):
+            if out != "array":
+                raise ValueError("out must be None, 'array' or an ndarray")
+            out = None
+
+        return extract_tiles(pixels, grid, out=out, workers=workers, pad=pad, fill=fill)
+    finally:
+        _close_uncached(source, image, cache)
+
+
+@functools.lru_cache(maxsize=32)
+def _blend_window(tile_size, kind):
+    """
+    Returns a read-only (tile_height, tile_width) float32 weight window that
+    falls off towards the tile borders, for blending overlapping tiles.
+    """
+    def profile(n):
+        t = (np.arange(n, dtype=np.float64) + 0.5) / n
+        if kind == "linear":
+            return 1 - np.abs(2 * t - 1)
+        if kind == "cosine":
+            return np.sin(np.pi * t) ** 2
+        if kind == "gaussian":
+            return np.exp(-0.5 * ((t - 0.5) / 0.125) ** 2)
+        raise ValueError("blend must be None, 'linear', 'cosine' or 'gaussian'")
+
     tile_width, tile_height = tile_size
+    window = np.outer(profile(tile_height), profile(tile_width))
+    # Keep the borders slightly positive so pixels covered by one tile still normalize
+    window = np.maximum(window, 1e-3).astype(np.float32)
+    window.flags.writeable = False
+    return window
 
-    # Calculate the number of crops needed in each dimension
-    num_crops_x = (width + tile_width - 1) // tile_width
-    num_crops_y = (height + tile_height - 1) // tile_height
-
-    # Create a list to store the cropped images
-    crops = []
-
-    # Crop the image into a grid
-    for i in range(num_crops_x):
-        for j in range(num_crops_y):
-            left = i * tile_width
-            upper = j * tile_height
-            right = min(left + tile_width, width)
-            lower = min(upper + tile_height, height)
-
-            # Crop the image
-            crop = image.crop((left, upper, right, lower))
-
-            # If the crop is smaller than the grid size, pad it with zeros
-            if crop.size != (tile_width, tile_height):
-                padded_crop = Image.new("RGB", (tile_width, tile_height))
-                padded_crop.paste(crop, (0, 0))
-                crops.append(padded_crop)
-            else:
-                crops.append(crop)
 
-    return crops
+def stitch_grid(tiles, grid, image_size=None, blend=None):
+    """
+    Reassembles tiles into one image-sized array, the inverse of crop_to_grid.
+    tiles holds one tile per grid entry, in grid order, as an (N, th, tw[, C])
+    array or a sequence of arrays or PIL images; padding is cropped away.
+    Overlapping tiles overwrite each other unless blend is "linear", "cosine" or
+    "gaussian", in which case they are averaged with that weight window.
+    Returns an (H, W[, C]) array of the tiles' dtype.
+    """
+    width, height = image_size or grid.image_size
+    first = np.asarray(tiles[0])
+    canvas_shape = (height, width) + first.shape[2:]
+
+    if blend is None:
+        canvas = np.zeros(canvas_shape, dtype=first.dtype)
+        for tile, (left, upper, right, lower) in zip(tiles, grid.boxes.tolist()):
+            canvas[upper:lower, left:right] = np.asarray(tile)[:lower - upper, :right - left]
+        return canvas
+
+    window = _blend_window(tuple(grid.tile_size), blend)
+    canvas = np.zeros(canvas_shape, dtype=np.float32)
+    weights = np.zeros((height, width), dtype=np.float32)
+    for tile, (left, upper, right, lower) in zip(tiles, grid.boxes.tolist()):
+        tile = np.asarray(tile)[:lower - upper, :right - left]
+        weight = window[:lower - upper, :right - left]
+        weights[upper:lower, left:right] += weight
+        if tile.ndim == 3:
+            weight = weight[:, :, np.newaxis]
+        canvas[upper:lower, left:right] += tile * weight
+
+    # Normalize by the accumulated weights; uncovered pixels stay zero
+    np.maximum(weights, np.finfo(np.float32).tiny, out=weights)
+    if canvas.ndim == 3:
+        weights = weights[:, :, np.newaxis]
+    canvas /= weights
+    if np.issubdtype(first.dtype, np.integer):
+        info = np.iinfo(first.dtype)
+        canvas = np.clip(np.rint(canvas), info.min, info.max)
+    return canvas.astype(first.dtype)
+
+
+def sliding_window(image, tile_size=(512, 512), stride=None, origin=(0, 0), edge_policy="pad",
+                   pad="constant", fill=0):
+    """
+    Slides a tile_size window over an image from origin in steps of stride.
+    Returns (grid, windows): the TileGrid of the windows, and a
+    (rows, cols, tile_height, tile_width, C) strided view with windows[row, col]
+    the window at that grid position. The source is converted to an array and,
+    for edge_policy="pad", padded once (see _pad_source); overlapping windows
+    share memory, so each source pixel is read once however much they overlap.
+    edge_policy="shift" and "drop" avoid padding (see TileGrid); shifted
+    windows are gathered into a copy since they are not evenly spaced.
+    """
+    array = _to_array(image)
+    height, width, channels = array.shape
+    tile_width, tile_height = tile_size
+    grid = TileGrid.for_size((width, height), tile_size, stride, origin, edge_policy)
+    stride_x, stride_y = grid.stride
+    origin_x, origin_y = grid.origin
+
+    if not len(grid):
+        return grid, np.zeros((grid.rows, grid.cols, tile_height, tile_width, channels), array.dtype)
+
+    # Window corners per column and row, relative to the origin
+    lefts = np.unique(grid.boxes[:, 0]) - origin_x
+    uppers = np.unique(grid.boxes[:, 1]) - origin_y
+
+    # Pad once so the last window along each axis fits
+    array = array[origin_y:, origin_x:]
+    pad_y = max(int(uppers[-1]) + tile_height - array.shape[0], 0)
+    pad_x = max(int(lefts[-1]) + tile_width - array.shape[1], 0)
+    array = _pad_source(array, pad_y, pad_x, pad, fill)
+
+    windows = np.lib.stride_tricks.sliding_window_view(array, (tile_height, tile_width), axis=(0, 1))
+    if edge_policy == "shift":
+        # Shifted windows are not evenly spaced, so gather them (this copies)
+        windows = windows[uppers][:, lefts]
+    else:
+        windows = windows[::stride_y, ::stride_x][:grid.rows, :grid.cols]
+    return grid, windows.transpose(0, 1, 3, 4, 2)
+
+
+MultiGrid = collections.namedtuple("MultiGrid", ["grids", "tiles", "grid_ids", "index"])
+
+
+def multi_offset_grids(image, tile_size=(512, 512), offsets=((0, 0), (256, 256)), edge_policy="pad",
+                       pad="constant", fill=0):
+    """
+    Cuts one grid per offset (e.g. an aligned and a half-shifted grid for
+    test-time augmentation) in a single pass over one padded copy of the source.
+    Windows that several grids share are extracted once.
+    Returns a MultiGrid of:
+      grids     one TileGrid per offset,
+      tiles     an (N, tile_height, tile_width, C) array of the unique windows,
+      grid_ids  an (N,) int32 array with the first grid that produced each tile,
+      index     one (rows, cols) int32 array per grid giving each position's tile.
+    """
+    array = _to_array(image)
+    height, width, channels = array.shape
+    tile_width, tile_height = tile_size
+    grids = [TileGrid.for_size((width, height), tile_size, origin=offset, edge=edge_policy)
+             for offset in offsets]
+
+    # Deduplicate windows by their top-left corner across all grids
+    corners = np.concatenate([grid.boxes[:, :2] for grid in grids])
+    owners = np.concatenate([np.full(len(grid), grid_id, dtype=np.int32)
+                             for grid_id, grid in enumerate(grids)])
+    unique, first, inverse = np.unique(corners, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1).astype(np.int32)
+
+    # Pad once so every window of every grid fits
+    if len(unique):
+        pad_y = max(int(unique[:, 1].max()) + tile_height - height, 0)
+        pad_x = max(int(unique[:, 0].max()) + tile_width - width, 0)
+        array = _pad_source(array, pad_y, pad_x, pad, fill)
+
+    tiles = np.empty((len(unique), tile_height, tile_width, channels), dtype=array.dtype)
+    for number, (left, upper) in enumerate(unique.tolist()):
+        tiles[number] = array[upper:upper + tile_height, left:left + tile_width]
+
+    index = []
+    start = 0
+    for grid in grids:
+        grid_index = np.full((grid.rows, grid.cols), -1, dtype=np.int32)
+        grid_index[grid.positions[:, 0], grid.positions[:, 1]] = inverse[start:start + len(grid)]
+        index.append(grid_index)
+        start += len(grid)
+
+    return MultiGrid(grids, tiles, owners[first], index)
+
+
+def crop_to_grid_array(image, tile_size=(512, 512), copy=False, pad="constant", fill=0):
+    """
+    Crops an image into a grid of specified size as a single ndarray.
+    Returns an array of shape (rows, cols, tile_height, tile_width, C).
+    The source is padded once to a multiple of the grid size (see _pad_source)
+    and the tiles are strided views into it; pass copy=True for a contiguous
+    array instead. Accepts PIL images and ndarrays.
+    """
+    _, tiles = sliding_window(image, tile_size, pad=pad, fill=fill)
+    if copy:
+        tiles = np.ascontiguousarray(tiles)
+    return tiles
 
 
 def crop_to_grid_with_offset(image, tile_size=(512, 512), offset=(256, 256)):
@@ -85,28 +1282,1322 @@ def crop_to_grid_with_offset(image, tile_size=(512, 512), offset=(256, 256)):
     Crops an image into a grid of specified size with an offset. 
     Pass for the remaining pixels if the image is not divisible by the grid size.
     """
+    source = _open_source(image)
+    try:
+        grid = TileGrid.for_size(_image_size(source), tile_size, origin=offset, edge="drop")
+        return [crop for _, _, _, crop in iter_tiles(source, grid)]
+    finally:
+        _close_opened(source, image)
+
+
+class TileCache:
+    """
+    Two-tier LRU cache of encoded tiles: up to max_bytes in memory and, when
+    directory is given, up to max_disk_bytes of files on disk. Disk entries are
+    written atomically and survive restarts; a disk hit is promoted to memory.
+    Keys are any tuple with a stable repr (see encode_grid). Thread-safe, and
+    several processes may share one directory: temporary files are named per
+    process and thread, and only those older than stale_seconds (left by a
+    crashed writer) are removed on start.
+    """
+
+    stale_seconds = 3600
+
+    def __init__(self, max_bytes=64 << 20, directory=None, max_disk_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._disk = collections.OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            # Rebuild the disk LRU from modification times, oldest first
+            entries = []
+            stale = time.time() - self.stale_seconds
+            for entry in os.scandir(directory):
+                try:
+                    stat = entry.stat()
+                    if entry.name.endswith(".tmp"):
+                        if stat.st_mtime < stale:
+                            os.remove(entry.path)
+                    elif entry.name.endswith(".tile"):
+                        entries.append((stat.st_mtime_ns, entry.name, stat.st_size))
+                except FileNotFoundError:
+                    # Renamed or removed by another process meanwhile
+                    pass
+            for _, name, size in sorted(entries):
+                self._disk[name] = size
+                self._disk_bytes += size
+            with self._lock:
+                self._evict_disk()
+
+    @staticmethod
+    def _file_name(key):
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".tile"
+
+    def get(self, key):
+        """
+        Returns the cached bytes for key, or None on a miss.
+        """
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return data
+            name = self._file_name(key)
+            if name not in self._disk:
+                self.misses += 1
+                return None
+            self._disk.move_to_end(name)
+
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as fp:
+                data = fp.read()
+            # Refresh the mtime so the LRU order survives a restart
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._disk_bytes -= self._disk.pop(name, 0)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        """
+        Stores data (bytes) under key in memory and, if enabled, on disk.
+        """
+        with self._lock:
+            self._remember(key, data)
+        if self.directory is None or len(data) > self.max_disk_bytes:
+            return
+
+        name = self._file_name(key)
+        path = os.path.join(self.directory, name)
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as fp:
+                fp.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        with self._lock:
+            self._disk_bytes -= self._disk.pop(name, 0)
+            self._disk[name] = len(data)
+            self._disk_bytes += len(data)
+            self._evict_disk()
+
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        self._memory_bytes -= len(self._memory.pop(key, b""))
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes:
+            name, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """
+        Returns the hit counters, the overall hit rate and the tier sizes as a dict.
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                    "memory_entries": len(self._memory), "memory_bytes": self._memory_bytes,
+                    "disk_entries": len(self._disk), "disk_bytes": self._disk_bytes}
+
+
+def _encode_tile(tile, format="png", **params):
+    """
+    Encodes a PIL tile to bytes; format is a file extension or a PIL format name.
+    """
+    buffer = io.BytesIO()
+    with _stage("encode"):
+        tile.save(buffer, format=Image.registered_extensions().get("." + format.lower(), format),
+                  **params)
+    return buffer.getvalue()
+
+
+def encode_grid(image, tile_size=(512, 512), offset=(0, 0), format="png", cache=None,
+                image_key=None, pad="constant", fill=0, **params):
+    """
+    Crops an image into a grid starting at offset and encodes each tile.
+    Returns a list of (row, col, data) in grid order, partial edge tiles padded.
+    With a TileCache as cache, tiles are looked up by (image key, tile_size,
+    offset, row, col, format) and only the missing ones are cropped and encoded;
+    when every tile hits, the image is not decoded at all. The image key is the
+    path, mtime and size of an image file, or image_key for in-memory images.
+    Extra keyword arguments are passed to Image.save and are part of the key.
+    """
+    tile_size = tuple(tile_size)
+    offset = tuple(offset)
+    if image_key is None and isinstance(image, (str, os.PathLike)):
+        image_key = _file_key(image)
+    source = _open_source(image)
+    try:
+        grid = TileGrid.for_size(_image_size(source), tile_size, origin=offset)
+
+        if cache is None or image_key is None:
+            return [(row, col, _encode_tile(tile, format, **params))
+                    for row, col, _, tile in iter_tiles(source, grid, pad, fill)]
+
+        # pad, fill and the encoder settings change the bytes, so they are keyed too;
+        # array fills become tuples so the key stays hashable
+        fill_key = np.asarray(fill).tolist()
+        if isinstance(fill_key, list):
+            fill_key = tuple(np.ravel(fill).tolist())
+        variant = (format.lower(), pad, fill_key, tuple(sorted(params.items())))
+        results = []
+        missing = []
+        for number, (row, col, _) in enumerate(grid):
+            data = cache.get((image_key, tile_size, offset, row, col, variant))
+            results.append((row, col, data))
+            if data is None:
+                missing.append(number)
+
+        if missing:
+            tiles = iter_tiles(source, grid.subset(missing), pad, fill)
+            for number, (row, col, _, tile) in zip(missing, tiles):
+                data = _encode_tile(tile, format, **params)
+                cache.put((image_key, tile_size, offset, row, col, variant), data)
+                results[number] = (row, col, data)
+        return results
+    finally:
+        _close_opened(source, image)
+
+
+def convert_to_memmap(src_path, dst_path=None, band_height=512):
+    """
+    Converts an image file (PNG, TIFF, ...) into a row-major .npy cache that the
+    tiling functions can memory-map, so later runs read only the rows they need.
+    The pixels are decoded and copied band_height rows at a time (see iter_bands),
+    so PNGs and row-ordered files never need to fit in memory. Returns the
+    read-only memmap.
+    """
+    if dst_path is None:
+        dst_path = os.path.splitext(src_path)[0] + ".npy"
+
+    with _open_unbounded(src_path) as image:
+        height = image.size[1]
+
+    # Write to a temporary file so a failed conversion never leaves a partial cache
+    tmp_path = dst_path + ".tmp"
+    cache = None
+    for upper, band in iter_bands(src_path, band_height):
+        pixels = np.asarray(band)
+        if cache is None:
+            cache = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=pixels.dtype,
+                                              shape=(height,) + pixels.shape[1:])
+        cache[upper:upper + len(pixels)] = pixels
+    cache.flush()
+    del cache
+
+    os.replace(tmp_path, dst_path)
+    return np.load(dst_path, mmap_mode="r")
+
+
+def _open_unbounded(path):
+    """
+    Opens an image file without PIL's decompression bomb check.
+    Only the header is read here; the banded readers bound the decoded size.
+    The format plugins are tried directly, the way Image.open does, instead of
+    lifting Image.MAX_IMAGE_PIXELS, which would disable the check for every
+    other thread opening images meanwhile.
+    """
+    with open(path, "rb") as fp:
+        prefix = fp.read(16)
+    for init in (Image.preinit, Image.init):
+        init()
+        for format_id in Image.ID:
+            factory, accept = Image.OPEN[format_id]
+            accepted = accept(prefix) if accept else True
+            if not accepted or isinstance(accepted, str):
+                continue
+            try:
+                return factory(os.fspath(path))
+            except (SyntaxError, IndexError, TypeError, struct.error):
+                continue
+    raise Image.UnidentifiedImageError("cannot identify image file {!r}".format(path))
+
+
+def _png_idat_stream(fp, offset):
+    """
+    Yields the contents of consecutive IDAT chunks, starting with the one whose
+    data begins at offset.
+    """
+    fp.seek(offset - 8)
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type != b"IDAT":
+            return
+        while length > 0:
+            data = fp.read(min(length, 1 << 20))
+            if not data:
+                return
+            length -= len(data)
+            yield data
+        fp.read(4)  # CRC
+
+
+def _iter_png_bands(image, band_height):
+    """
+    Decodes a non-interlaced PNG band by band.
+    The zlib stream is inflated incrementally, and each band's filtered rows are
+    unfiltered by PIL's PNG decoder, seeded with the last row of the previous band.
+    """
+    width, height = image.size
+    tile = image.tile[0]
+    rawmode = tile.args if isinstance(tile.args, str) else tile.args[0]
+
+    # Bytes per filtered scanline from the IHDR chunk, plus the filter type byte
+    image.fp.seek(16)
+    _, _, bit_depth, color_type = struct.unpack(">IIBB", image.fp.read(10))
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    row_bytes = (width * channels * bit_depth + 7) // 8
+    stride = row_bytes + 1
+
+    inflater = zlib.decompressobj()
+    chunks = _png_idat_stream(image.fp, tile.offset)
+    pending = bytearray()
+    previous_row = None
+    for upper in range(0, height, band_height):
+        lower = min(upper + band_height, height)
+        needed = (lower - upper) * stride
+        while len(pending) < needed:
+            # Inflate no more than the band needs; the rest waits in unconsumed_tail
+            data = inflater.unconsumed_tail or next(chunks, None)
+            if data is None:
+                raise ValueError("truncated PNG data")
+            pending += inflater.decompress(data, needed - len(pending))
+        filtered = bytes(pending)
+        pending.clear()
+
+        # Up/Average/Paeth rows refer to the row above, so replay it unfiltered
+        rows = lower - upper
+        if previous_row is not None:
+            filtered = b"\0" + previous_row + filtered
+            rows += 1
+        data = zlib.compress(filtered, 0)
+        band = Image.frombytes(image.mode, (width, rows), data, "zip", rawmode)
+        # Slice bytes rather than crop: Image.crop applies the decompression bomb check
+        pixels = band.tobytes("raw", rawmode)
+        if previous_row is not None:
+            band = Image.frombytes(image.mode, (width, rows - 1), pixels[row_bytes:], "raw",
+                                   rawmode)
+        if image.mode == "P" and image.palette is not None:
+            palette_mode, palette = image.palette.getdata()
+            band.putpalette(palette, palette_mode)
+
+        previous_row = pixels[-row_bytes:]
+        yield upper, band
+
+
+def _iter_raw_bands(image, band_height):
+    """
+    Reads an image stored as uncompressed, top-down rows (uncompressed TIFF
+    strips, PPM, ...) band by band, seeking straight to each band's rows.
+    """
     width, height = image.size
+    strips = sorted(image.tile, key=lambda tile: tile.extents[1])
+    for upper in range(0, height, band_height):
+        lower = min(upper + band_height, height)
+        band = Image.new(image.mode, (width, lower - upper))
+        for tile in strips:
+            _, strip_upper, _, strip_lower = tile.extents
+            top, bottom = max(upper, strip_upper), min(lower, strip_lower)
+            if top >= bottom:
+                continue
+            rawmode, row_bytes = tile.args[0], tile.args[1]
+            if not row_bytes:
+                row_bytes = len(Image.new(image.mode, (width, 1)).tobytes("raw", rawmode))
+            image.fp.seek(tile.offset + (top - strip_upper) * row_bytes)
+            data = image.fp.read((bottom - top) * row_bytes)
+            strip = Image.frombytes(image.mode, (width, bottom - top), data, "raw", rawmode, row_bytes)
+            band.paste(strip, (0, top - upper))
+        yield upper, band
+
+
+def _can_pack(mode, rawmode):
+    try:
+        Image.new(mode, (1, 1)).tobytes("raw", rawmode)
+    except ValueError:
+        return False
+    return True
+
+
+def iter_bands(path, band_height=512):
+    """
+    Decodes an image file in horizontal bands of band_height rows.
+    Yields (upper, band) with band a PIL image of the rows from upper on.
+    Non-interlaced PNGs, uncompressed row-ordered files and TIFFs that
+    TiledTiffReader can read (tiled, or compressed strips) are decoded one band at
+    a time, so memory stays near width * band_height pixels and PIL's
+    MAX_IMAGE_PIXELS limit does not apply. Other files are decoded in full, and
+    so are subject to that limit.
+    """
+    image = _open_unbounded(path)
+    reader = None
+    try:
+        width, height = image.size
+        tiles = image.tile
+        png = (image.format == "PNG" and not image.info.get("interlace")
+               and len(tiles) == 1 and tiles[0].codec_name == "zip"
+               and _can_pack(image.mode, tiles[0].args))
+        raw = tiles and all(tile.codec_name == "raw" and tile.extents[0] == 0
+                            and tile.extents[2] == width
+                            and (len(tile.args) < 3 or tile.args[2] == 1)
+                            for tile in tiles)
+        if not png and not raw and image.format == "TIFF":
+            # Keep one row of tiles cached: it may be shared with the next band
+            reader = TiledTiffReader.open(path, strips=True,
+                                          cache_tiles=-(-width // image.tag_v2.get(322, width)))
+
+        if png:
+            yield from _iter_png_bands(image, band_height)
+        elif raw:
+            yield from _iter_raw_bands(image, band_height)
+        elif reader is not None:
+            for upper in range(0, height, band_height):
+                yield upper, reader.crop((0, upper, width, min(upper + band_height, height)))
+        else:
+            # No row access for this format; decode once and hand out bands
+            Image._decompression_bomb_check(image.size)
+            image.load()
+            for upper in range(0, height, band_height):
+                yield upper, image.crop((0, upper, width, min(upper + band_height, height)))
+    finally:
+        if reader is not None:
+            reader.close()
+        image.close()
+
+
+def iter_grid_tiles_banded(path, tile_size=(512, 512)):
+    """
+    Crops an image file into a grid of specified size while decoding it one row
+    of tiles at a time. Yields (row, col, box, tile) like iter_grid_tiles, with
+    the same tiles, but row by row so each decoded band can be freed.
+    """
     tile_width, tile_height = tile_size
-    offset_x, offset_y = offset
+    with _open_unbounded(path) as image:
+        grid = TileGrid.for_size(image.size, tile_size)
+
+    # Group tile numbers by grid row, keeping columns in order
+    by_row = np.lexsort((grid.positions[:, 1], grid.positions[:, 0]))
+    for upper, band in iter_bands(path, tile_height):
+        row = upper // tile_height
+        for index in by_row[row * grid.cols:(row + 1) * grid.cols].tolist():
+            left, _, right, lower = grid[index]
+            crop = _crop_padded(band, (left, 0, right, lower - upper), tile_size)
+            yield row, int(grid.positions[index, 1]), grid[index], crop
+
+
+_DZI_XML = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+            'Format="{}" Overlap="0" TileSize="{}"><Size Width="{}" Height="{}"/></Image>\n')
+
+
+def _source_bands(image, band_height):
+    """
+    Returns ((width, height), bands) with bands yielding (upper, band) like
+    iter_bands. Image files go through iter_bands; memory maps, tiled TIFFs and
+    in-memory images are cropped band by band.
+    """
+    source = image
+    if isinstance(image, (str, os.PathLike)):
+        path = os.fspath(image)
+        source = None
+        if path.endswith(".npy") or path.lower().endswith((".tif", ".tiff")):
+            source = _open_source(path)
+        if not isinstance(source, (np.ndarray, TiledTiffReader)):
+            if source is not None:
+                source.close()
+            with _open_unbounded(path) as opened:
+                size = opened.size
+            return size, iter_bands(path, band_height)
+
+    width, height = _image_size(source)
+    bands = ((upper, _crop(source, (0, upper, width, min(upper + band_height, height))))
+             for upper in range(0, height, band_height))
+    return (width, height), _closing(bands, source, image)
+
+
+def _downsample_2x2(blocks):
+    """
+    Joins up to 2x2 neighbouring tiles (a list of rows of tiles) and halves the result.
+    """
+    first = blocks[0][0]
+    canvas = Image.new(first.mode, (sum(tile.width for tile in blocks[0]),
+                                    sum(row[0].height for row in blocks)))
+    upper = 0
+    for row in blocks:
+        left = 0
+        for tile in row:
+            canvas.paste(tile, (left, upper))
+            left += tile.width
+        upper += row[0].height
+    return _reduce(canvas, 2)
+
+
+def iter_pyramid_tiles(image, tile_size=256):
+    """
+    Lazily yields (level, col, row, tile) for every tile of a DeepZoom pyramid,
+    where level (max(width, height) - 1).bit_length() is full resolution and each level below
+    halves it, down to a single pixel at level 0. Edge tiles are clipped.
+    The image is read once, one row of full-resolution tiles at a time, and every
+    other level is built by 2x2-downsampling the tiles of the level above as each
+    pair of tile rows completes, so at most one row per level is held at a time.
+    """
+    size, bands = _source_bands(image, tile_size)
+    return _pyramid_tiles(size, bands, tile_size)
+
+
+def _pyramid_tiles(size, bands, tile_size):
+    width, height = size
+    max_level = (max(width, height) - 1).bit_length()
+    level_rows = {}
+    for level in range(max_level + 1):
+        level_height = -(-height // (1 << (max_level - level)))
+        level_rows[level] = -(-level_height // tile_size)
+    pending = {}
+
+    def push(level, row, tiles):
+        for col, tile in enumerate(tiles):
+            yield level, col, row, tile
+        if level == 0:
+            return
+        if row % 2 == 0 and row + 1 < level_rows[level]:
+            pending[level] = tiles
+            return
+        rows = [pending.pop(level), tiles] if row % 2 else [tiles]
+        with _stage("downsample"):
+            merged = [_downsample_2x2([row_tiles[col:col + 2] for row_tiles in rows])
+                      for col in range(0, len(tiles), 2)]
+        yield from push(level - 1, row // 2, merged)
+
+    for upper, band in bands:
+        if band.mode in ("1", "P", "PA"):
+            with _stage("convert"):
+                band = band.convert("L" if band.mode == "1" else "RGBA")
+        tiles = [band.crop((left, 0, min(left + tile_size, band.width), band.height))
+                 for left in range(0, band.width, tile_size)]
+        yield from push(max_level, upper // tile_size, tiles)
+
+
+def build_pyramid(image, dst, tile_size=256, format="png", workers=None, max_in_flight=None):
+    """
+    Writes a DeepZoom pyramid of an image: the descriptor dst + ".dzi" and the
+    tiles as dst + "_files/<level>/<col>_<row>.<format>" (see iter_pyramid_tiles).
+    Tiles of all levels are encoded and written on a thread pool as they are
+    produced, with at most max_in_flight in memory, and each is renamed into
+    place once complete; the descriptor is written last. Returns the number of
+    tiles written.
+    """
+    files_dir = dst + "_files"
+    format_name = Image.registered_extensions().get("." + format.lower(), format)
+    made_dirs = set()
+
+    def save_tile(entry):
+        level, col, row, tile = entry
+        path = os.path.join(files_dir, str(level), "{}_{}.{}".format(col, row, format))
+        with _stage("encode"):
+            tile.save(path + ".tmp", format=format_name)
+        os.replace(path + ".tmp", path)
+
+    def with_dirs(entries):
+        for entry in entries:
+            if entry[0] not in made_dirs:
+                os.makedirs(os.path.join(files_dir, str(entry[0])), exist_ok=True)
+                made_dirs.add(entry[0])
+            yield entry
+
+    size, bands = _source_bands(image, tile_size)
+    count = 0
+    tiler = ParallelTiler(workers, max_in_flight)
+    for _ in tiler.map(save_tile, with_dirs(_pyramid_tiles(size, bands, tile_size))):
+        count += 1
+
+    # The descriptor goes last, so a .dzi that exists has all of its tiles
+    with open(dst + ".dzi.tmp", "w", encoding="utf-8") as fp:
+        fp.write(_DZI_XML.format(format, tile_size, *size))
+    os.replace(dst + ".dzi.tmp", dst + ".dzi")
+    return count
+
+
+class TiledTiffReader:
+    """
+    Random-access reader for tiled TIFF files.
+    crop(box) decodes only the internal TIFF tiles that intersect box, so tiling
+    a huge file never decodes the full frame. Recently decoded internal tiles are
+    kept so neighbouring crops can share them.
+    Supports uncompressed, LZW, Deflate, PackBits and JPEG tiles with chunky
+    samples; use TiledTiffReader.open to fall back to PIL for anything else.
+    LZW tiles are decoded by libtiff through PIL, so they need a PIL built with it.
+    With strips=True, stripped files are read too, each strip being a tile as
+    wide as the image (the last one may be shorter); iter_bands uses this.
+    Strips over Image.MAX_IMAGE_PIXELS raise DecompressionBombError.
+    The file stays open until close().
+    """
+    __slots__ = ("path", "size", "mode", "tile_size", "_rawmode", "_offsets", "_byte_counts",
+                 "_compression", "_predictor", "_dtype", "_jpeg_tables", "_jpeg_rgb", "_cache",
+                 "_cache_tiles", "_lock", "_fp", "_tile_header", "_tile_ifd", "_strips")
+
+    _COMPRESSIONS = (1, 5, 7, 8, 32773, 32946)
+
+    def __init__(self, path, cache_tiles=64, strips=False):
+        with _open_unbounded(path) as image:
+            tags = image.tag_v2
+            tiled = 322 in tags and 323 in tags
+            if not tiled and not (strips and 273 in tags and 279 in tags):
+                raise ValueError("{} is not a tiled TIFF".format(path))
+            compression = tags.get(259, 1)
+            predictor = tags.get(317, 1)
+            if compression not in self._COMPRESSIONS or predictor not in (1, 2):
+                raise ValueError("unsupported TIFF compression {} / predictor {}".format(
+                    compression, predictor))
+            if tags.get(284, 1) != 1:
+                raise ValueError("planar TIFF tiles are not supported")
+            if compression == 5 and not features.check("libtiff"):
+                raise ValueError("LZW TIFF tiles need PIL with libtiff")
+            bits = tuple(tags.get(258, (8,)))
+            if bits[0] not in (8, 16, 32) or any(b != bits[0] for b in bits):
+                # e.g. 1-bit masks: leave them to PIL
+                raise ValueError("unsupported TIFF bits per sample {}".format(bits))
+
+            self.path = path
+            self.size = image.size
+            self.mode = image.mode
+            self._strips = not tiled
+            if tiled:
+                self.tile_size = (int(tags[322]), int(tags[323]))
+            else:
+                self.tile_size = (image.size[0], min(int(tags.get(278, image.size[1])),
+                                                     image.size[1]))
+                # Each strip decodes whole, so a huge one is subject to PIL's limit
+                Image._decompression_bomb_check(self.tile_size)
+            # Raw tile bytes are in file byte order, whatever PIL's own rawmode says
+            big_endian = tags.prefix == b"MM"
+            sample_format = tags.get(339, (1,))[0]
+            if bits[0] == 8:
+                self._rawmode = image.tile[0].args[0]
+            elif len(bits) > 1:
+                raise ValueError("only 8-bit samples are supported with several channels")
+            elif sample_format == 3:
+                if bits[0] != 32 or predictor != 1:
+                    raise ValueError("unsupported floating point TIFF samples")
+                self._rawmode = "F;32BF" if big_endian else "F;32F"
+            else:
+                self._rawmode = "I;{}{}{}".format(bits[0], "B" if big_endian else "",
+                                                  "S" if sample_format == 2 else "")
+            self._offsets = tuple(tags[324 if tiled else 273])
+            self._byte_counts = tuple(tags[325 if tiled else 279])
+            self._compression = compression
+            self._predictor = predictor
+            self._jpeg_tables = tags.get(347)
+            self._jpeg_rgb = tags.get(262) == 2
+
+            # Sample type for undoing horizontal differencing
+            self._dtype = np.dtype("u{}".format(bits[0] // 8)).newbyteorder(
+                ">" if big_endian else "<")
+
+            if compression == 5:
+                self._init_tile_container(tags)
+
+        self._cache = collections.OrderedDict()
+        self._cache_tiles = cache_tiles
+        self._lock = threading.Lock()
+        self._fp = open(path, "rb")
+
+    def _init_tile_container(self, tags):
+        """
+        Prepares a one-tile TIFF directory with the file's sample layout, used to
+        hand single LZW tiles to libtiff.
+        """
+        ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix=tags.prefix)
+        for tag in (258, 259, 262, 277, 284, 317, 338, 339):
+            if tag in tags:
+                ifd[tag] = tags[tag]
+                ifd.tagtype[tag] = tags.tagtype[tag]
+        ifd[256], ifd[257] = self.tile_size
+        ifd[322], ifd[323] = self.tile_size
+        for tag in (256, 257, 322, 323, 324, 325):
+            ifd.tagtype[tag] = TiffTags.LONG
+        ifd[324] = ifd[325] = 0
+        # The tile data goes right after the directory, whose size does not depend on it
+        self._tile_header = tags.prefix + (b"*\0" if tags.prefix == b"II" else b"\0*") \
+            + struct.pack((">" if tags.prefix == b"MM" else "<") + "I", 8)
+        ifd[324] = 8 + len(ifd.tobytes(8))
+        self._tile_ifd = ifd
+
+    @classmethod
+    def open(cls, path, cache_tiles=64, strips=False):
+        """
+        Returns a reader for path, or None if it is not a tiled TIFF this reader supports.
+        """
+        try:
+            return cls(path, cache_tiles=cache_tiles, strips=strips)
+        except (ValueError, OSError, KeyError, IndexError):
+            return None
+
+    def _read_tile(self, index):
+        if hasattr(os, "pread"):
+            return os.pread(self._fp.fileno(), self._byte_counts[index], self._offsets[index])
+        with self._lock:
+            self._fp.seek(self._offsets[index])
+            return self._fp.read(self._byte_counts[index])
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _decode_tile(self, index):
+        tile_width, tile_height = self.tile_size
+        # Tiles are padded to full size, but a last strip holds only the remaining rows
+        tiles_across = -(-self.size[0] // tile_width)
+        if self._strips:
+            tile_height = min(tile_height, self.size[1] - index // tiles_across * tile_height)
+        data = self._read_tile(index)
+
+        if self._compression == 7:
+            if self._jpeg_tables:
+                data = self._jpeg_tables[:-2] + data[2:]
+            tile = Image.open(io.BytesIO(data))
+            if self._jpeg_rgb:
+                # Photometric RGB: the JPEG holds RGB samples, not YCbCr
+                tile.tile = [tile.tile[0]._replace(args=(tile.tile[0].args[0], "RGB"))]
+            tile.load()
+            return tile
+        if self._compression == 32773:
+            return Image.frombytes(self.mode, (tile_width, tile_height), data, "packbits",
+                                   self._rawmode)
+        if self._compression == 5:
+            with self._lock:
+                self._tile_ifd[325] = len(data)
+                self._tile_ifd[257] = self._tile_ifd[323] = tile_height
+                directory = self._tile_ifd.tobytes(8)
+            tile = Image.open(io.BytesIO(self._tile_header + directory + data))
+            tile.load()
+            return tile
+        if self._compression in (8, 32946):
+            data = zlib.decompress(data)
+
+        if self._predictor == 2:
+            samples = np.frombuffer(data, dtype=self._dtype)
+            samples = samples[:tile_width * tile_height * (samples.size // (tile_width * tile_height))]
+            samples = samples.reshape(tile_height, tile_width, -1)
+            # cumsum returns native byte order; rawmode expects the file's
+            data = np.cumsum(samples, axis=1, dtype=self._dtype).astype(self._dtype).tobytes()
+        return Image.frombytes(self.mode, (tile_width, tile_height), data, "raw", self._rawmode)
+
+    def get_tile(self, index):
+        """
+        Returns internal TIFF tile number index as a PIL image, decoding it if needed.
+        """
+        with self._lock:
+            tile = self._cache.get(index)
+            if tile is not None:
+                self._cache.move_to_end(index)
+                return tile
+        with _stage("decode"):
+            tile = self._decode_tile(index)
+        with self._lock:
+            self._cache[index] = tile
+            while len(self._cache) > self._cache_tiles:
+                self._cache.popitem(last=False)
+        return tile
+
+    def crop(self, box):
+        """
+        Crops box out of the image, decoding only the TIFF tiles it covers.
+        """
+        left, upper, right, lower = box
+        width, height = self.size
+        tile_width, tile_height = self.tile_size
+        tiles_across = (width + tile_width - 1) // tile_width
+        crop = Image.new(self.mode, (right - left, lower - upper))
+
+        for tile_y in range(max(upper, 0) // tile_height, (min(lower, height) - 1) // tile_height + 1):
+            for tile_x in range(max(left, 0) // tile_width, (min(right, width) - 1) // tile_width + 1):
+                tile = self.get_tile(tile_y * tiles_across + tile_x)
+                x0, y0 = tile_x * tile_width, tile_y * tile_height
+                region = (max(left, x0) - x0, max(upper, y0) - y0,
+                          min(right, x0 + tile_width, width) - x0,
+                          min(lower, y0 + tile_height, height) - y0)
+                crop.paste(tile.crop(region), (max(left, x0) - left, max(upper, y0) - upper))
+        return crop
+
+
+class ParallelTiler:
+    """
+    Fans tile extraction and per-tile work (such as encoding and saving) out over
+    a thread pool. PIL and zlib release the GIL while cropping and encoding, so
+    this scales across cores. Results come back in tile order, and at most
+    max_in_flight tiles are queued or held at any time.
+    """
+
+    def __init__(self, workers=None, max_in_flight=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_in_flight = max_in_flight or 2 * self.workers
+
+    def map(self, func, items):
+        """
+        Yields func(item) for each item, in order, running up to workers calls at once.
+        """
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            pending = collections.deque()
+            for item in items:
+                if len(pending) >= self.max_in_flight:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(func, item))
+            while pending:
+                yield pending.popleft().result()
+
+    def iter_tiles(self, image, grid, pad="constant", fill=0):
+        """
+        Parallel iter_tiles: yields (row, col, box, tile) in grid order.
+        """
+        # Decode once up front; PIL's lazy load is not safe to race
+        source = _decode(_open_source(image))
+
+        def crop_tile(entry):
+            row, col, box = entry
+            return row, col, box, _crop_padded(source, box, grid.tile_size, pad, fill)
+
+        return _closing(self.map(crop_tile, grid), source, image)
+
+    def save_tiles(self, image, grid, path_template, format=None, **params):
+        """
+        Crops every tile of grid and saves it to path_template.format(row=row, col=col),
+        cropping and encoding on the pool. Returns the written paths in grid order.
+        Extra keyword arguments are passed to Image.save.
+        """
+        def save_tile(entry):
+            row, col, box, tile = entry
+            path = path_template.format(row=row, col=col)
+            with _stage("encode"):
+                tile.save(path, format=format, **params)
+            return path
+
+        return list(self.map(save_tile, self.iter_tiles(image, grid)))
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".webp", ".npy")
+
+
+def iter_image_files(src_dir):
+    """
+    Lazily yields the paths of image files under src_dir, relative to it, in sorted order.
+    """
+    for root, dirs, files in os.walk(src_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.relpath(os.path.join(root, name), src_dir)
+
+
+def tile_file(src_path, dst_dir, tile_size=(512, 512), format="png"):
+    """
+    Crops an image file into a grid and saves the tiles into dst_dir as
+    <name>_<width>x<height>_r<row>_c<col>.<format>, where name keeps the source
+    extension so a.png and a.jpg do not overwrite each other, and the tile size
+    keeps tilings of different sizes apart. Returns the number of tiles written.
+    Each tile is written to a temporary file, fsynced and renamed into place, and
+    the directory is fsynced at the end, so once this returns the tiles survive
+    a power loss and a tile file that exists is always complete.
+    """
+    os.makedirs(dst_dir, exist_ok=True)
+    name = os.path.basename(src_path)
+    format_name = Image.registered_extensions().get("." + format.lower(), format)
+    image = _open_source(src_path)
+    try:
+        count = 0
+        for row, col, box, tile in iter_grid_tiles(image, tile_size):
+            path = os.path.join(dst_dir, "{}_{}x{}_r{}_c{}.{}".format(
+                name, tile_size[0], tile_size[1], row, col, format))
+            with open(path + ".tmp", "wb") as fp:
+                with _stage("encode"):
+                    tile.save(fp, format=format_name)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(path + ".tmp", path)
+            count += 1
+        _fsync_dir(dst_dir)
+        return count
+    finally:
+        if hasattr(image, "close"):
+            image.close()
+
+
+def _fsync_dir(path):
+    """
+    Makes renames inside directory path durable, where the platform supports it.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Windows cannot fsync directories
+        pass
+    finally:
+        os.close(fd)
+
+
+def _tile_file_job(job):
+    return tile_file(*job)
+
+
+class TileJournal:
+    """
+    Append-only journal of source images whose tiles are all written, used to
+    resume batch tiling. The first line is "# <settings>" (e.g. tile size and
+    format); each further line is "<tiles>\t<relative path>". An image is
+    recorded only after its last tile is durably in place, and a torn last line
+    left by a crash is discarded on open. A journal written with different
+    settings (or none) is started afresh, so every image is tiled again.
+    """
+
+    def __init__(self, path, settings=""):
+        self.path = path
+        self.settings = settings
+        self.completed = {}
+        header = "# {}\n".format(settings).encode("utf-8")
+
+        valid_bytes = 0
+        if os.path.exists(path):
+            with open(path, "rb") as fp:
+                if fp.readline() == header:
+                    valid_bytes = len(header)
+                    for line in fp:
+                        if not line.endswith(b"\n"):
+                            break
+                        count, _, rel_path = line[:-1].decode("utf-8").partition("\t")
+                        self.completed[rel_path] = int(count)
+                        valid_bytes += len(line)
+            # Drop a partially written last line, or everything if the settings
+            # changed, so new entries start cleanly
+            if valid_bytes != os.path.getsize(path):
+                os.truncate(path, valid_bytes)
+
+        self._file = open(path, "a", encoding="utf-8")
+        if not valid_bytes:
+            self._file.write(header.decode("utf-8"))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def __contains__(self, rel_path):
+        return rel_path in self.completed
+
+    def record(self, rel_path, tiles):
+        """
+        Marks rel_path as done with the given number of tiles.
+        """
+        self._file.write("{}\t{}\n".format(tiles, rel_path))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.completed[rel_path] = tiles
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def tile_directory(src_dir, dst_dir, tile_size=(512, 512), workers=None, format="png",
+                   report_every=10.0, resume=True):
+    """
+    Tiles every image under src_dir into dst_dir, mirroring its subdirectories.
+    Images are spread over a process pool by path, so only paths and tile counts
+    cross process boundaries, and at most 2 * workers images are queued at once.
+    Finished images are recorded in dst_dir/.tile_journal; with resume=True they
+    are skipped on the next run, otherwise the journal is started afresh. The
+    journal is also restarted when tile_size or format differ from its run;
+    since tile names carry the size and format, the new tiles never mix with
+    (or are mistaken for) those of the earlier settings.
+    An image that fails (e.g. an unreadable file) is reported and counted but
+    not journaled, so it is retried next run without stopping the others.
+    Returns (images, tiles, seconds, failed) for the images tiled in this run.
+    """
+    workers = workers or os.cpu_count() or 1
+    images = tiles = skipped = failed = 0
+    start = last_report = time.perf_counter()
+
+    def report(final=False):
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        print("{} {} images, {} tiles in {:.1f}s ({:.1f} images/s, {:.1f} tiles/s), {} skipped, "
+              "{} failed".format("tiled" if final else "...", images, tiles, elapsed,
+                                 images / elapsed, tiles / elapsed, skipped, failed),
+              file=sys.stderr)
+
+    os.makedirs(dst_dir, exist_ok=True)
+    journal_path = os.path.join(dst_dir, ".tile_journal")
+    if not resume and os.path.exists(journal_path):
+        os.remove(journal_path)
+
+    settings = "tile_size={}x{} format={}".format(tile_size[0], tile_size[1], format)
+    with TileJournal(journal_path, settings) as journal, \
+            concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        pending = collections.deque()
+
+        def finish():
+            nonlocal images, tiles, failed
+            rel_path, future = pending.popleft()
+            try:
+                count = future.result()
+            except Exception as error:
+                failed += 1
+                print("failed {}: {}".format(rel_path, error), file=sys.stderr)
+                return
+            journal.record(rel_path, count)
+            tiles += count
+            images += 1
+
+        for rel_path in iter_image_files(src_dir):
+            if rel_path in journal:
+                skipped += 1
+                continue
+            job = (os.path.join(src_dir, rel_path),
+                   os.path.join(dst_dir, os.path.dirname(rel_path)), tuple(tile_size), format)
+            pending.append((rel_path, pool.submit(_tile_file_job, job)))
+            while len(pending) >= 2 * workers or (pending and pending[0][1].done()):
+                finish()
+            if report_every and time.perf_counter() - last_report >= report_every:
+                last_report = time.perf_counter()
+                report()
+        while pending:
+            finish()
+
+    report(final=True)
+    return images, tiles, time.perf_counter() - start, failed
+
+
+class TileServer:
+    """
+    Local asyncio HTTP server for the images under root, computing only the
+    requested tile. Two URL schemes are served, relative to root:
+    <path>/<z>/<x>/<y>.<format> for XYZ viewers (zoom level max_zoom is full
+    resolution, each lower level halves it; tiles are padded) and DeepZoom,
+    <path>.dzi plus <path>_files/<level>/<col>_<row>.<format> (edge tiles are
+    clipped). Decoding and encoding run on a thread pool, decoded levels go
+    through a DecodedImageCache and encoded tiles through a TileCache, and
+    concurrent requests for the same level or tile share one computation.
+    Tiles carry an ETag derived from the file's path, mtime and size, so
+    If-None-Match requests are answered with 304 without touching the image.
+    Full-resolution tiles of tiled TIFFs and .npy files are read through one
+    open TiledTiffReader or memory map per file (up to max_readers files), so
+    their internal tile cache is shared between requests. Only tile_formats
+    are served; other extensions are answered with 404.
+    """
+
+    max_sizes = 4096
+    max_readers = 64
+    tile_formats = ("png", "jpg", "jpeg", "webp")
+
+    _xyz_route = re.compile(r"^/(.+)/(\d+)/(\d+)/(\d+)\.(\w+)$")
+    _dzi_route = re.compile(r"^/(.+)\.dzi$")
+    _dzi_tile_route = re.compile(r"^/(.+)_files/(\d+)/(\d+)_(\d+)\.(\w+)$")
+
+    def __init__(self, root, tile_size=256, format="png", workers=None, tile_cache=None,
+                 image_cache=None):
+        if format.lower() not in self.tile_formats:
+            raise ValueError("tile format must be one of {}".format(", ".join(self.tile_formats)))
+        self.root = os.path.realpath(root)
+        self.tile_size = tile_size
+        self.format = format
+        self.tiles = tile_cache or TileCache()
+        self.images = image_cache or decoded_images
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers or os.cpu_count() or 1)
+        self._inflight = {}
+        self._sizes = collections.OrderedDict()
+        # file key -> [reader or None, requests using it, evicted]
+        self._readers = collections.OrderedDict()
+
+    def run(self, host="127.0.0.1", port=8000):
+        """
+        Serves until interrupted.
+        """
+        try:
+            asyncio.run(self.serve(host, port))
+        finally:
+            self._executor.shutdown()
+            while self._readers:
+                self._evict_reader()
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        server = await asyncio.start_server(self._handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readuntil(b"\r\n\r\n")
+                lines = request.decode("latin-1").split("\r\n")
+                method, target, version = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                status, response_headers, body = await self._respond(method, target, headers)
+                keep_alive = (version == "HTTP/1.1"
+                              and headers.get("connection", "").lower() != "close")
+                head = ["HTTP/1.1 {} {}".format(status, http.HTTPStatus(status).phrase),
+                        "Content-Length: {}".format(len(body)),
+                        "Connection: {}".format("keep-alive" if keep_alive else "close")]
+                head += ["{}: {}".format(name, value) for name, value in response_headers.items()]
+                writer.write("\r\n".join(head).encode("latin-1") + b"\r\n\r\n")
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError,
+                ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, method, target, headers):
+        """
+        Returns (status, headers, body) for a request.
+        """
+        if method not in ("GET", "HEAD"):
+            return 405, {"Allow": "GET, HEAD"}, b""
+        path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        try:
+            match = self._dzi_route.match(path)
+            if match:
+                width, height = await self._size(self._source(match.group(1)))
+                body = _DZI_XML.format(self.format, self.tile_size, width, height)
+                return 200, {"Content-Type": "application/xml"}, body.encode("utf-8")
+
+            match = self._dzi_tile_route.match(path)
+            if match:
+                name, level, col, row, format = match.groups()
+                padded = False
+            else:
+                match = self._xyz_route.match(path)
+                if not match:
+                    return 404, {}, b""
+                name, level, col, row, format = match.groups()
+                padded = True
+            format_name = Image.registered_extensions().get("." + format.lower())
+            if format.lower() not in self.tile_formats or format_name not in Image.SAVE:
+                return 404, {}, b""
+
+            source = self._source(name)
+            key = (_file_key(source), self.tile_size, int(level), int(col), int(row),
+                   format.lower(), padded)
+            etag = '"{}"'.format(hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:24])
+            response_headers = {"ETag": etag, "Cache-Control": "no-cache"}
+            if etag in [tag.strip() for tag in headers.get("if-none-match", "").split(",")]:
+                return 304, response_headers, b""
+
+            body = await self._once(key, self._tile, source, key)
+            response_headers["Content-Type"] = Image.MIME.get(format_name,
+                                                              "application/octet-stream")
+            return 200, response_headers, body
+        except (FileNotFoundError, NotADirectoryError, IndexError):
+            return 404, {}, b""
+        except Exception as error:
+            warnings.warn("tile request {} failed: {!r}".format(target, error))
+            return 500, {}, b""
+
+    def _source(self, name):
+        """
+        Resolves a URL path to an image file under root.
+        """
+        path = os.path.realpath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            raise FileNotFoundError(name)
+        return path
+
+    def _once(self, key, func, *args):
+        """
+        Runs the coroutine func(*args) once per key; concurrent callers share the result.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return asyncio.shield(task)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _size(self, source):
+        file_key = _file_key(source)
+        size = self._sizes.get(file_key)
+        if size is None:
+            size = await self._run(_source_size, source)
+            self._sizes[file_key] = size
+            while len(self._sizes) > self.max_sizes:
+                self._sizes.popitem(last=False)
+        else:
+            self._sizes.move_to_end(file_key)
+        return size
+
+    async def _tile(self, source, key):
+        data = await self._run(self.tiles.get, key)
+        if data is not None:
+            return data
+
+        file_key, tile_size, level, col, row, format, padded = key
+        width, height = await self._size(source)
+        if padded:
+            max_level = max(0, (-(-max(width, height) // tile_size) - 1).bit_length())
+        else:
+            max_level = (max(width, height) - 1).bit_length()
+        if level > max_level:
+            raise IndexError("no level {}".format(level))
+        factor = 1 << (max_level - level)
+        level_size = (-(-width // factor), -(-height // factor))
+        left, upper = col * tile_size, row * tile_size
+        if left >= level_size[0] or upper >= level_size[1]:
+            raise IndexError("no tile {}, {} at level {}".format(col, row, level))
+        box = (left, upper, min(left + tile_size, level_size[0]),
+               min(upper + tile_size, level_size[1]))
+
+        entry = await self._reader(source, file_key) if factor == 1 else [None]
+        if entry[0] is not None:
+            entry[1] += 1
+            try:
+                data = await self._run(self._render, entry[0], box, format, padded)
+            finally:
+                entry[1] -= 1
+                if entry[2] and not entry[1]:
+                    entry[0].close()
+        else:
+            image = await self._once((file_key, factor), self._run, self.images.get, source,
+                                     1 / factor)
+            data = await self._run(self._render, image, box, format, padded)
+        await self._run(self.tiles.put, key, data)
+        return data
+
+    async def _reader(self, source, file_key):
+        """
+        Returns the shared [reader, users, evicted] entry of a tiled TIFF or .npy
+        source, opening it on first use; reader is None for other files.
+        """
+        entry = self._readers.get(file_key)
+        if entry is not None:
+            self._readers.move_to_end(file_key)
+            return entry
+        reader = await self._once((file_key, "reader"), self._run, _open_lazy_source, source)
+        # Concurrent callers share the open; the first one stores it
+        entry = self._readers.get(file_key)
+        if entry is None:
+            while self._readers and len(self._readers) >= self.max_readers:
+                self._evict_reader()
+            entry = self._readers[file_key] = [reader, 0, False]
+        return entry
+
+    def _evict_reader(self):
+        # A reader still rendering a tile is closed by its last user instead
+        _, entry = self._readers.popitem(last=False)
+        entry[2] = True
+        if entry[0] is not None and not entry[1]:
+            entry[0].close()
+
+    def _render(self, image, box, format, padded):
+        if padded:
+            tile = _crop_padded(image, box, (self.tile_size, self.tile_size))
+        else:
+            tile = _crop(image, box)
+        if format in ("jpg", "jpeg") and tile.mode not in ("L", "RGB", "CMYK"):
+            with _stage("convert"):
+                tile = tile.convert("RGB")
+        return _encode_tile(tile, format)
+
 
-    # Calculate the number of crops needed in each dimension
-    num_crops_x = (width - offset_x - 1) // tile_width
-    num_crops_y = (height- offset_y- 1) // tile_height
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m crop_extension",
+                                     description="Batch image tiling and tile serving.")
+    commands = parser.add_subparsers(dest="command", required=True)
 
-    # Create a list to store the cropped images
-    crops = []
-    # Crop the image into a grid
-    for i in range(num_crops_x):
-        for j in range(num_crops_y):
-            left = i * tile_width
-            upper = j * tile_height
-            right = min(left + tile_width, width)
-            lower = min(upper + tile_height, height)
+    tile = commands.add_parser("tile", help="crop every image under SRC into tiles in DST")
+    tile.add_argument("src")
+    tile.add_argument("dst")
+    tile.add_argument("--tile", default="512", metavar="SIZE",
+                      help="tile size, e.g. 512 or 512x256 (default: 512)")
+    tile.add_argument("--workers", type=int, default=None, help="processes (default: all cores)")
+    tile.add_argument("--format", default="png", help="tile file format (default: png)")
+    tile.add_argument("--restart", action="store_true",
+                      help="ignore the progress journal and tile everything again")
 
-            # Crop the image
-            crop = image.crop((left, upper, right, lower))
-            crops.append(crop)
-    return crops
+    serve = commands.add_parser("serve",
+                                help="serve XYZ and DeepZoom tiles of the images under ROOT")
+    serve.add_argument("root")
+    serve.add_argument("--host", default="127.0.0.1", help="address to bind (default: 127.0.0.1)")
+    serve.add_argument("--port", type=int, default=8000, help="port (default: 8000)")
+    serve.add_argument("--tile", type=int, default=256, help="tile size (default: 256)")
+    serve.add_argument("--format", default="png", choices=TileServer.tile_formats,
+                       help="DeepZoom tile format (default: png)")
+    serve.add_argument("--workers", type=int, default=None, help="threads (default: all cores)")
+    serve.add_argument("--cache-dir", default=None,
+                       help="also keep encoded tiles in this directory")
 
+    args = parser.parse_args(argv)
+    if args.command == "tile":
+        sizes = [int(v) for v in args.tile.lower().split("x")]
+        tile_size = (sizes[0], sizes[-1])
+        failed = tile_directory(args.src, args.dst, tile_size, workers=args.workers,
+                                format=args.format, resume=not args.restart)[3]
+        if failed:
+            return 1
+    elif args.command == "serve":
+        server = TileServer(args.root, args.tile, args.format, workers=args.workers,
+                            tile_cache=TileCache(directory=args.cache_dir))
+        print("serving {} on http://{}:{}/".format(args.root, args.host, args.port))
+        try:
+            server.run(args.host, args.port)
+        except KeyboardInterrupt:
+            pass
+    return 0
 
 
+if __name__ == "__main__":
+    sys.exit(main())
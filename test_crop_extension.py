@@ -0,0 +1,297 @@
+import asyncio
+import os
+import struct
+import zlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import crop_extension
+
+
+def _wide_png(path, mode, width=6000, height=300):
+    rng = np.random.default_rng(0)
+    # Noise with flat runs, so the encoder mixes filter types across rows
+    if mode == "I;16":
+        array = rng.integers(0, 65536, (height, width), dtype=np.uint16)
+        array[:, ::5] = 0
+        image = Image.frombytes(mode, (width, height), array.tobytes())
+    else:
+        channels = {"L": 1, "RGB": 3, "RGBA": 4, "P": 1}[mode]
+        array = rng.integers(0, 256, (height, width, channels), dtype=np.uint8)
+        array[:, ::5] = 0
+        image = Image.fromarray(array[:, :, 0] if channels == 1 else array)
+        if mode == "P":
+            image = image.convert("P")
+    image.save(path)
+    return path
+
+
+def _tiled_tiff(path, array, tile_size=(256, 256), byteorder="<", compression=1, predictor=1):
+    # Minimal tiled TIFF writer: raw or Deflate tiles, optional horizontal predictor
+    array = array if array.ndim == 3 else array[:, :, None]
+    height, width, channels = array.shape
+    tile_width, tile_height = tile_size
+    tiles = []
+    for upper in range(0, height, tile_height):
+        for left in range(0, width, tile_width):
+            tile = np.zeros((tile_height, tile_width, channels), array.dtype)
+            block = array[upper:upper + tile_height, left:left + tile_width]
+            tile[:block.shape[0], :block.shape[1]] = block
+            if predictor == 2:
+                tile[:, 1:] = tile[:, 1:] - tile[:, :-1]
+            data = tile.astype(tile.dtype.newbyteorder(byteorder)).tobytes()
+            tiles.append(zlib.compress(data) if compression == 8 else data)
+
+    offsets = np.cumsum([8] + [len(data) for data in tiles[:-1]]).tolist()
+    sample_format = {"u": 1, "i": 2, "f": 3}[array.dtype.kind]
+    entries = [(256, 4, [width]), (257, 4, [height]), (258, 3, [array.itemsize * 8] * channels),
+               (259, 3, [compression]), (262, 3, [2 if channels == 3 else 1]),
+               (277, 3, [channels]), (284, 3, [1]), (317, 3, [predictor]),
+               (322, 3, [tile_width]), (323, 3, [tile_height]), (324, 4, offsets),
+               (325, 4, [len(data) for data in tiles]), (339, 3, [sample_format] * channels)]
+    body = b"".join(tiles)
+    ifd_offset = 8 + len(body)
+    extra_offset = ifd_offset + 2 + 12 * len(entries) + 4
+    ifd, extra = struct.pack(byteorder + "H", len(entries)), b""
+    for tag, kind, values in entries:
+        packed = struct.pack(byteorder + ("H" if kind == 3 else "I") * len(values), *values)
+        if len(packed) <= 4:
+            ifd += struct.pack(byteorder + "HHI", tag, kind, len(values)) + packed.ljust(4, b"\0")
+        else:
+            ifd += struct.pack(byteorder + "HHII", tag, kind, len(values),
+                               extra_offset + len(extra))
+            extra += packed
+    header = (b"II*\0" if byteorder == "<" else b"MM\0*") + struct.pack(byteorder + "I",
+                                                                        ifd_offset)
+    with open(path, "wb") as fp:
+        fp.write(header + body + ifd + struct.pack(byteorder + "I", 0) + extra)
+    return str(path)
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA", "P", "I;16"])
+def test_banded_png_matches_crop_to_grid(tmp_path, mode):
+    path = str(_wide_png(tmp_path / "wide.png", mode))
+    tile_size = (512, 128)
+    expected = crop_extension.crop_to_grid(path, tile_size, order="row")
+    banded = list(crop_extension.iter_grid_tiles_banded(path, tile_size))
+    assert len(banded) == len(expected)
+    for (_, _, _, tile), reference in zip(banded, expected):
+        assert tile.mode == reference.mode
+        assert tile.tobytes() == reference.tobytes()
+
+
+def test_iter_bands_covers_png(tmp_path):
+    path = str(_wide_png(tmp_path / "wide.png", "RGB", width=9000, height=257))
+    with Image.open(path) as image:
+        reference = np.asarray(image)
+    bands = list(crop_extension.iter_bands(path, band_height=64))
+    assert [upper for upper, _ in bands] == list(range(0, 257, 64))
+    assert np.array_equal(np.concatenate([np.asarray(band) for _, band in bands]), reference)
+
+
+@pytest.mark.parametrize("compression", ["tiff_lzw", "tiff_deflate", "packbits"])
+def test_iter_bands_decodes_compressed_tiff_strips(tmp_path, monkeypatch, compression):
+    array = np.random.default_rng(0).integers(0, 256, (1000, 700, 3), dtype=np.uint8)
+    path = str(tmp_path / "strips.tif")
+    Image.fromarray(array).save(path, compression=compression, tiffinfo={278: 37})
+    # Far below the full frame, but above one strip and one band
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 50000)
+    bands = list(crop_extension.iter_bands(path, band_height=64))
+    assert np.array_equal(np.concatenate([np.asarray(band) for _, band in bands]), array)
+
+
+def test_iter_bands_keeps_bomb_check_for_full_decodes(tmp_path, monkeypatch):
+    path = str(tmp_path / "photo.jpg")
+    Image.new("RGB", (700, 1000)).save(path)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 50000)
+    with pytest.raises(Image.DecompressionBombError):
+        list(crop_extension.iter_bands(path))
+
+
+@pytest.mark.parametrize("mode", ["L", "I;16", "I", "F"])
+def test_foreground_mask_handles_high_bit_depths(mode):
+    # Dark tissue in the top-left quarter of a bright background
+    rng = np.random.default_rng(0)
+    array = 40000 + rng.integers(-500, 500, (1024, 1024))
+    array[:512, :512] = 3000 + rng.integers(-500, 500, (512, 512))
+    if mode == "L":
+        image = Image.fromarray((array >> 8).astype(np.uint8))
+    elif mode == "I;16":
+        image = Image.frombytes(mode, (1024, 1024), array.astype("<u2").tobytes())
+    else:
+        image = Image.fromarray(array.astype(np.int32 if mode == "I" else np.float32))
+    assert image.mode == mode
+
+    mask = crop_extension.foreground_mask(image)
+    assert mask[:16, :16].all() and not mask[16:, 16:].any()
+    tiles = crop_extension.crop_to_grid(image, (256, 256), foreground=0.5)
+    assert len(tiles) == 4
+
+
+def test_tiled_tiff_readers_opened_from_paths_are_closed(tmp_path, monkeypatch):
+    array = np.random.default_rng(0).integers(0, 256, (700, 900, 3), dtype=np.uint8)
+    path = _tiled_tiff(tmp_path / "tiled.tif", array, compression=8)
+    readers = []
+    open_reader = crop_extension.TiledTiffReader.open
+
+    def recording_open(*args, **kwargs):
+        reader = open_reader(*args, **kwargs)
+        readers.append(reader)
+        return reader
+
+    monkeypatch.setattr(crop_extension.TiledTiffReader, "open", recording_open)
+
+    tiles = crop_extension.crop_to_grid(path, (256, 256))
+    assert np.array_equal(np.asarray(tiles[0]), array[:256, :256])
+    list(crop_extension.iter_grid_tiles(path, (256, 256)))
+    crop_extension.random_crop_containing_bbox(path, [300, 300, 10, 10], (256, 256))
+    crop_extension.tile_file(path, str(tmp_path / "tiles"), (256, 256))
+    assert len(readers) == 4
+    assert all(reader._fp.closed for reader in readers)
+
+
+def test_tile_server_shares_readers_and_rejects_other_formats(tmp_path, monkeypatch):
+    array = np.random.default_rng(0).integers(0, 256, (1000, 1200, 3), dtype=np.uint8)
+    _tiled_tiff(tmp_path / "slide.tif", array, compression=8)
+    readers = []
+    init = crop_extension.TiledTiffReader.__init__
+
+    def recording_init(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        readers.append(self)
+
+    monkeypatch.setattr(crop_extension.TiledTiffReader, "__init__", recording_init)
+    server = crop_extension.TileServer(str(tmp_path), tile_cache=crop_extension.TileCache(0))
+
+    async def get(path):
+        return await server._respond("GET", path, {})
+
+    async def requests():
+        tiles = [await get("/slide.tif/3/{}/{}.png".format(x, y)) for x in range(4)
+                 for y in range(3)]
+        return tiles, await get("/slide.tif/3/0/0.pdf"), await get("/slide.tif/3/0/0.gif")
+
+    tiles, pdf, gif = asyncio.run(requests())
+    assert [status for status, _, _ in tiles] == [200] * 12
+    assert pdf[0] == gif[0] == 404
+    # One reader for the size lookup, one shared by every full-resolution tile
+    assert len(readers) == 2 and sum(not reader._fp.closed for reader in readers) == 1
+
+
+def test_tile_journal_drops_torn_line(tmp_path):
+    path = str(tmp_path / "journal")
+    with crop_extension.TileJournal(path, "tile_size=256x256") as journal:
+        journal.record("a.png", 4)
+        journal.record("sub/b.png", 9)
+    with open(path, "ab") as fp:
+        fp.write(b"12\tc.pn")
+
+    with crop_extension.TileJournal(path, "tile_size=256x256") as journal:
+        assert journal.completed == {"a.png": 4, "sub/b.png": 9}
+        journal.record("c.png", 12)
+    with open(path, encoding="utf-8") as fp:
+        assert fp.read() == "# tile_size=256x256\n4\ta.png\n9\tsub/b.png\n12\tc.png\n"
+
+
+def test_tile_journal_restarts_on_other_settings(tmp_path):
+    path = str(tmp_path / "journal")
+    with crop_extension.TileJournal(path, "tile_size=256x256") as journal:
+        journal.record("a.png", 4)
+    with crop_extension.TileJournal(path, "tile_size=512x512") as journal:
+        assert "a.png" not in journal
+    with open(path, encoding="utf-8") as fp:
+        assert fp.read() == "# tile_size=512x512\n"
+
+
+def test_tile_directory_keeps_tile_sizes_apart(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    Image.new("RGB", (600, 500)).save(src / "a.png")
+    Image.new("RGB", (600, 500)).save(src / "a.jpg")
+    dst = str(tmp_path / "dst")
+    assert crop_extension.tile_directory(str(src), dst, (256, 256), workers=1)[1] == 12
+    assert crop_extension.tile_directory(str(src), dst, (512, 512), workers=1)[1] == 4
+    names = sorted(name for name in os.listdir(dst) if not name.startswith("."))
+    assert len(names) == 16
+    for name in names:
+        size = int(name.split("_")[1].split("x")[0])
+        with Image.open(os.path.join(dst, name)) as tile:
+            assert tile.size == (size, size)
+
+
+@pytest.mark.parametrize("byteorder", ["<", ">"])
+@pytest.mark.parametrize("compression, predictor", [(1, 1), (8, 1), (8, 2)])
+@pytest.mark.parametrize("dtype", ["u2", "i2", "u4", "i4", "f4"])
+def test_tiled_tiff_reader_matches_source(tmp_path, dtype, compression, predictor, byteorder):
+    if dtype == "f4" and predictor == 2:
+        pytest.skip("floating point predictor is not supported")
+    if dtype == "u4" and byteorder == ">":
+        pytest.skip("PIL cannot open big-endian uint32 TIFFs")
+    rng = np.random.default_rng(0)
+    if dtype == "f4":
+        array = (rng.standard_normal((300, 520)) * 1000).astype(dtype)
+    else:
+        info = np.iinfo(dtype)
+        array = rng.integers(info.min, info.max, (300, 520), dtype=dtype, endpoint=True)
+    path = _tiled_tiff(tmp_path / "tiled.tif", array, (256, 256), byteorder, compression,
+                       predictor)
+
+    with crop_extension.TiledTiffReader(path) as reader:
+        crop = np.asarray(reader.crop((10, 20, 500, 290)))
+    # 32-bit unsigned samples come back as PIL "I" (int32); compare modulo 2**32
+    assert np.array_equal(crop.astype(dtype), array[20:290, 10:500])
+
+
+def test_scaled_decoding_leaves_caller_image_alone(tmp_path):
+    path = str(tmp_path / "photo.jpg")
+    Image.fromarray(np.random.default_rng(0).integers(0, 256, (800, 1000, 3), dtype=np.uint8)
+                    ).save(path)
+    with Image.open(path) as image:
+        tiles = crop_extension.crop_to_grid(image, (64, 64), scale=1 / 4)
+        assert image.size == (1000, 800)
+        assert len(tiles) == 4 * 4
+    # Opened from the path, draft mode may decode at reduced size directly
+    assert crop_extension._open_scaled(path, 1 / 4).size == (250, 200)
+
+
+@pytest.mark.parametrize("scale", [0, -1, 0.3, 2])
+def test_scale_must_be_a_unit_fraction(scale):
+    with pytest.raises(ValueError):
+        crop_extension.crop_to_grid(Image.new("L", (64, 64)), (32, 32), scale=scale)
+
+
+def _reference_tile_stats(array, grid):
+    # Direct per-tile mean and std of the gray values, in exact integers where possible
+    gray = array[:, :, :3].astype(object).sum(axis=2) if array.ndim == 3 else array.astype(object)
+    channels = 3 if array.ndim == 3 else 1
+    means, stds = [], []
+    for left, upper, right, lower in grid.boxes.tolist():
+        values = gray[upper:lower, left:right].ravel()
+        count = max(values.size, 1)
+        mean = sum(values) / (channels * count)
+        square_mean = sum(value * value for value in values) / (channels * channels * count)
+        means.append(float(mean))
+        stds.append(float(max(square_mean - mean * mean, 0)) ** 0.5)
+    return np.array(means), np.array(stds)
+
+
+@pytest.mark.parametrize("band_bytes", [1, 4096, 16 << 20])
+def test_tile_stats_matches_direct_computation(band_bytes):
+    array = np.random.default_rng(0).integers(0, 256, (300, 500, 3), dtype=np.uint8)
+    grid = crop_extension.TileGrid.for_size((500, 300), (64, 48), stride=(40, 30))
+    mean, std = crop_extension.tile_stats(Image.fromarray(array), grid, band_bytes)
+    expected_mean, expected_std = _reference_tile_stats(array, grid)
+    assert np.allclose(mean, expected_mean) and np.allclose(std, expected_std)
+
+
+def test_tile_stats_survives_table_wrap_around():
+    # Squares near 2**60: the whole-image tables wrap past 2**64, single tiles do not
+    array = np.random.default_rng(0).integers(0, 1 << 30, (16, 16), dtype=np.int32)
+    assert (array.astype(object) ** 2).sum() >= 1 << 64
+    grid = crop_extension.TileGrid.for_size((16, 16), (4, 2))
+    mean, std = crop_extension.tile_stats(array, grid)
+    expected_mean, expected_std = _reference_tile_stats(array, grid)
+    assert np.allclose(mean, expected_mean, rtol=1e-9)
+    assert np.allclose(std, expected_std, rtol=1e-6)